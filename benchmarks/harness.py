@@ -31,6 +31,11 @@ DEFAULT_BENCHMARKS = [
   'aircraft',
 ]
 
+MEMORY_BENCHMARKS = [
+  'radar',
+  'slam',
+]
+
 DEFAULT_METHODS = [
   'ssi',
   'ds',
@@ -567,6 +572,62 @@ def run_benchmark(benchmark, output, n, handlers, methods, files, error_func, ra
     artifact.add_file(results_file)
     wandb.log_artifact(artifact)
 
+# Runs benchmark executable and reports the peak memory used per particle
+def run_memory(benchmark, file, handler, method, particles, seed, timeout):
+  cmd = f'siren {file} -m {method} -l {handler} --particles {particles} --samples {particles} --memory'
+  if seed is not None:
+    cmd += f' --seed {seed}'
+
+  tqdm.tqdm.write('>' + cmd)
+
+  try:
+    out = subprocess.check_output(cmd, cwd=CWD, shell=True, stderr=subprocess.STDOUT, timeout=timeout).decode("utf-8")
+  except subprocess.TimeoutExpired as e:
+    tqdm.tqdm.write(f'Timeout: {file}')
+    return None
+  except subprocess.CalledProcessError as e:
+    output = e.output.decode("utf-8")
+    tqdm.tqdm.write(output)
+    return None
+
+  lines = out.strip().split('\n')
+  for i, line in enumerate(lines):
+    line = line.strip()
+    if line == '===== Peak Memory Per Particle =====':
+      return float(lines[i + 1])
+  raise RuntimeError('Peak memory per particle not found')
+
+def memory_benchmark(benchmark, output, handlers, methods, files, particles, seed, timeout=300):
+  with open(os.path.join(benchmark, 'config.json')) as f:
+    config = json.load(f)
+
+  if len(files) == 0:
+    files = sorted(config['plans'].keys(), key=int)
+    files = [os.path.join(BENCHMARK_DIR, benchmark, 'programs', f'plan{plan_id}.si') for plan_id in files]
+
+  results_file = os.path.join(benchmark, output, 'memory.csv')
+  if not os.path.exists(results_file):
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, 'w') as f:
+      writer = csv.writer(f)
+      writer.writerow(['plan_id', 'handler', 'method', 'particles', 'bytes_per_particle'])
+
+  for handler in handlers:
+    for method in methods:
+      # Only measure plans that run with this handler and method
+      plan_files = [file for file in files if config['plans'][get_plan_id(file)]['satisfiable'][handler][method]]
+      for file in plan_files:
+        plan_id = get_plan_id(file)
+        for p in particles:
+          bytes_per_particle = run_memory(benchmark, file, handler, method, p, seed, timeout)
+          if bytes_per_particle is None:
+            bytes_per_particle = -1
+          print(f'{benchmark} plan{plan_id} {handler} {method} - {p} particles: {bytes_per_particle:.0f} peak bytes/particle')
+
+          with open(results_file, 'a') as f:
+            writer = csv.writer(f)
+            writer.writerow([plan_id, handler, method, p, bytes_per_particle])
+
 def analyze_benchmark(benchmark, files, output, handlers, methods):
   with open(os.path.join(benchmark, 'config.json')) as f:
     config = json.load(f)
@@ -733,6 +794,9 @@ if __name__ == '__main__':
 
   rp = sp.add_parser('check')
 
+  mp = sp.add_parser('memory')
+  mp.add_argument('--particles', '-p', type=int, required=False, nargs='+', default=[100])
+
   kp = sp.add_parser('kicktires')
   aep = sp.add_parser('artifact-eval')
 
@@ -760,6 +824,15 @@ if __name__ == '__main__':
     particles = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
     
     evaluation(particles, n, args, timeout=300)
+  elif args.subparser_name == 'memory':
+    benchmarks = [b.strip() for b in args.benchmark.split(',')] if args.benchmark is not None else MEMORY_BENCHMARKS
+    methods = [m.strip() for m in args.methods.split(',')] if args.methods is not None else DEFAULT_METHODS
+    handlers = [h.strip() for h in args.handlers.split(',')] if args.handlers is not None else ['smc']
+    files = [f.strip() for f in args.files.split(',')] if args.files is not None else []
+
+    for benchmark in benchmarks:
+      print('Benchmark: {}'.format(benchmark))
+      memory_benchmark(benchmark, args.output, handlers, methods, files, args.particles, args.seed)
   else:
     benchmarks = [b.strip() for b in args.benchmark.split(',')] if args.benchmark is not None else DEFAULT_BENCHMARKS
     methods = [m.strip() for m in args.methods.split(',')] if args.methods is not None else DEFAULT_METHODS
@@ -3,50 +3,13 @@ import numpy as np
 from copy import copy, deepcopy
 
 from siren.grammar import *
-from siren.utils import get_abs_pair, get_abs_lst
+from siren.utils import get_abs_pair, get_abs_lst, purity
 from siren.analysis.interface import *
 from siren.inference_plan import DistrEnc
 
 # Inference plan analysis
 # Mostly mirrors siren/evaluate.py
 
-# true if expr does not contain resample and observe
-def pure(expr: Expr[AbsSymExpr], functions: Dict[Identifier, Function]) -> bool:
-  def _pure(expr: Expr[AbsSymExpr]) -> bool:
-    # All symbolic expressions are pure
-    if isinstance(expr, AbsSymExpr):
-      return True
-    
-    match expr:
-      case Const(_): # a bit hacky, but Const counts has external grammar as well, so have to check here
-        return True
-      case Resample():
-        return False
-      case Observe(_, _):
-        return False
-      case Identifier(_, _):
-        return True
-      case GenericOp(op, args):
-        return all(_pure(arg) for arg in args)
-      case Fold(func, init, acc):
-        return _pure(functions[func].body) and _pure(init) and _pure(acc)
-      case Apply(func, args):
-        return all(_pure(arg) for arg in args) and _pure(functions[func].body)
-      case AbsLst(exprs):
-        return all(_pure(expr) for expr in exprs)
-      case AbsPair(fst, snd):
-        return _pure(fst) and _pure(snd)
-      case IfElse(cond, true, false):
-        return _pure(cond) and _pure(true) and _pure(false)
-      case Let(_, value, body):
-        return _pure(value) and _pure(body)
-      case LetRV(_, _, distribution, expression):
-        return _pure(distribution) and _pure(expression)
-      case _:
-        raise ValueError(expr)
-      
-  return _pure(expr)
-
 def match_pattern(pattern: List[Any], expr: AbsSymExpr) -> AbsContext:
     if len(pattern) == 0:
       return AbsContext()
@@ -69,6 +32,7 @@ class AbsHandler(object):
     self,
     particle: AbsParticle, 
     functions: Dict[Identifier, Function[AbsSymExpr]],
+    purity: Dict[int, bool],
   ) -> AbsParticle:
     def _evaluate_args(particle: AbsParticle, 
                       args: List[Expr[AbsSymExpr]], 
@@ -271,7 +235,7 @@ class AbsHandler(object):
     def _evaluate_file(particle: AbsParticle, func: Identifier, args: List[Expr[AbsSymExpr]]) -> AbsParticle:
       assert func.module == 'File'
       match func.name:
-        case 'read':
+        case 'read' | 'stream':
           # File operations can only read in constants, but we don't know the length of the file
           (p1, old_args, new_args) = _evaluate_args(particle, args, [])
           assert len(old_args) == 0
@@ -369,7 +333,7 @@ class AbsHandler(object):
           cond_val = p1.final_expr
 
           # if both branches are pure, we can evaluate them as ite
-          if len(cond_val.rvs()) > 0 and pure(true, functions) and pure(false, functions):
+          if len(cond_val.rvs()) > 0 and purity[id(true)] and purity[id(false)]:
             p2 = _evaluate(p1.update(cont=true))
             then_val = p2.final_expr
             p3 = _evaluate(p2.update(cont=false))
@@ -451,7 +415,7 @@ class AbsHandler(object):
 
     # Initialize particles
     probstate = AbsProbState(expression, method, self.value(), max_rvs)
-    probstate.particles = self.evaluate_particle(probstate.particles, functions)
+    probstate.particles = self.evaluate_particle(probstate.particles, functions, purity(program))
 
     probstate.result()
     inferred_plan = probstate.particles.state.plan
@@ -1,50 +1,18 @@
-from typing import Any, Optional, List, Dict, Tuple, ParamSpec, Callable
+from typing import Any, Optional, List, Dict, Tuple, ParamSpec, Callable, TextIO, Deque
 import numpy as np
 import os
-from multiprocessing import Pool, cpu_count, Queue, Process
+from multiprocessing import Pool, cpu_count, Queue, Process, Pipe
+from multiprocessing.connection import Connection
 import time
+import warnings
 from copy import copy, deepcopy
+from collections import deque
 
 from siren.grammar import *
-from siren.utils import get_pair, get_lst
-from siren.inference.interface import SymState, Context, ProbState, Particle
+from siren.utils import get_pair, get_lst, purity
+from siren.inference.interface import SymState, Context, ProbState, Particle, particle_seed
+from siren.inference.vectorized import VectorizedProbState, Divergence, scalar
     
-# true if expr does not contain resample and observe
-def pure(expr: Expr[SymExpr], functions: Dict[Identifier, Function]) -> bool:
-  def _pure(expr: Expr[SymExpr]) -> bool:
-    # All symbolic expressions are pure
-    if isinstance(expr, SymExpr):
-      return True
-    
-    match expr:
-      case Resample():
-        return False
-      case Observe(_, _):
-        return False
-      case Identifier(_, _):
-        return True
-      case GenericOp(op, args):
-        return all(_pure(arg) for arg in args)
-      # TODO: save purity of functions in functions to avoid recomputation
-      case Fold(func, init, acc):
-        return _pure(functions[func].body) and _pure(init) and _pure(acc)
-      case Apply(func, args):
-        return all(_pure(arg) for arg in args) and _pure(functions[func].body)
-      case Lst(exprs):
-        return all(_pure(expr) for expr in exprs)
-      case Pair(fst, snd):
-        return _pure(fst) and _pure(snd)
-      case IfElse(cond, true, false):
-        return _pure(cond) and _pure(true) and _pure(false)
-      case Let(_, value, body):
-        return _pure(value) and _pure(body)
-      case LetRV(_, _, distribution, expression):
-        return _pure(distribution) and _pure(expression)
-      case _:
-        raise ValueError(expr)
-      
-  return _pure(expr)
-
 # Match pattern to expression
 def match_pattern(pattern: List[Any], expr: SymExpr) -> Context:
     if len(pattern) == 0:
@@ -61,372 +29,654 @@ def match_pattern(pattern: List[Any], expr: SymExpr) -> Context:
       else:
         return match_pattern(pattern[0], fst) | match_pattern(pattern[1:], snd)
 
-P = ParamSpec("P")
+# Args can be a list of expressions, so need to extract them 
+# if only a single argument (or none)
+def _convert_args(args: List[SymExpr]) -> SymExpr:
+  if len(args) == 0:
+    return Const(None)
+  elif len(args) == 1:
+    return args[0]
+  else:
+    return Pair(args[0], _convert_args(args[1:]))
 
-class Handler(object):
-  # Evaluates a single particle 
+# Built-in operators, mapping the converted arguments to the symbolic expression
+def _unop(constructor: Any) -> Callable[[Particle, SymExpr], SymExpr]:
+  return lambda particle, args: constructor(args)
+
+def _binop(constructor: Any) -> Callable[[Particle, SymExpr], SymExpr]:
+  def _apply(particle: Particle, args: SymExpr) -> SymExpr:
+    fst, snd = get_pair(args)
+    return constructor(fst, snd)
+  return _apply
+
+# Arithmetic and comparisons of constants are evaluated right away, so values accumulated
+# over many steps (as by fold) do not build expressions as deep as the number of steps
+def _constop(constructor: Any) -> Callable[[Particle, SymExpr], SymExpr]:
+  def _apply(particle: Particle, args: SymExpr) -> SymExpr:
+    fst, snd = get_pair(args)
+    expr = constructor(fst, snd)
+    if isinstance(fst, Const) and isinstance(snd, Const):
+      return particle.state.eval(expr)
+    return expr
+  return _apply
+
+def _triop(constructor: Any) -> Callable[[Particle, SymExpr], SymExpr]:
+  def _apply(particle: Particle, args: SymExpr) -> SymExpr:
+    fst, args2 = get_pair(args)
+    snd, trd = get_pair(args2)
+    return constructor(fst, snd, trd)
+  return _apply
+
+# Empty list is considered a Constant
+def _make_list(x: SymExpr) -> SymExpr:
+  if isinstance(x, Const):
+    if x.v is None:
+      return Const([])
+  return Lst(PList.empty.cons(x))
+
+def _uniform_int(particle: Particle, args: SymExpr) -> SymExpr:
+  a, b = get_pair(args)
+  # For now, uniform only takes constants
+  # [a, b]
+  # Represented as a categorical distribution
+  match (particle.state.eval(a), particle.state.eval(b)):
+    case (Const(a), Const(b)):
+      a, b = scalar(a), scalar(b)
+      assert isinstance(a, Number) and isinstance(b, Number)\
+        and round(a) == a and round(b) == b and a <= b
+      a, b = int(a), int(b)
+      probs = Const(list(np.ones(b - a + 1) / (b - a + 1)))
+      return Categorical(Const(a), Const(b), probs)
+    case _:
+      raise ValueError(args)
+
+# Map to the correct operator
+def _operator(op: Operator) -> Callable[[Particle, SymExpr], SymExpr]:
+  match op.name:
+    case "add":
+      return _constop(Add)
+    case "sub":
+      # a - b = a + (-1 * b)
+      return _constop(lambda fst,snd: Add(fst, Mul(Const(-1), snd)))
+    case "mul":
+      return _constop(Mul)
+    case "div":
+      return _constop(Div)
+    case "eq":
+      return _constop(Eq)
+    case "lt":
+      return _constop(Lt)
+    case "cons":
+      return _binop(lambda fst,snd: Lst(get_lst(snd).cons(fst)))
+    case "lst":
+      return _unop(_make_list)
+    case "pair":
+      return _binop(Pair)
+    case "gaussian":
+      return _binop(Normal)
+    case "beta":
+      return _binop(Beta)
+    case "bernoulli":
+      return _unop(Bernoulli)
+    case "binomial":
+      return _binop(Binomial)
+    case "beta_binomial":
+      return _triop(BetaBinomial)
+    case "negative_binomial":
+      return _binop(NegativeBinomial)
+    case "exponential":
+      # Exponential is a special case of Gamma
+      # Represented as a Gamma so can be detected when applying 
+      # conjugacy rules
+      return _unop(lambda args: Gamma(Const(1.0), args))
+    case "gamma":
+      return _binop(Gamma)
+    case "poisson":
+      return _unop(Poisson)
+    case "delta":
+      return _unop(Delta)
+    case "categorical":
+      return _triop(Categorical)
+    case "uniform_int":
+      return _uniform_int
+    case "student_t":
+      return _triop(StudentT)
+    case _:
+      raise ValueError(op.name)
+
+# List library functions
+def _list_hd(particle: Particle, args: SymExpr) -> SymExpr:
+  exprs = get_lst(args)
+  if len(exprs) == 0:
+    raise ValueError(args)
+  return exprs.head
+
+def _list_tl(particle: Particle, args: SymExpr) -> SymExpr:
+  exprs = get_lst(args)
+  if len(exprs) == 0:
+    raise ValueError(args)
+  return Lst(exprs.tail)
+
+def _list_len(particle: Particle, args: SymExpr) -> SymExpr:
+  return Const(len(get_lst(args)))
+
+def _list_range(particle: Particle, args: SymExpr) -> SymExpr:
+  # Range only takes constants
+  a, b = get_pair(args)
+  match particle.state.eval(a), particle.state.eval(b):
+    case Const(a), Const(b):
+      a, b = scalar(a), scalar(b)
+      assert isinstance(a, Number) and isinstance(b, Number) and a <= b
+      return Lst(PList.of(map(Const, range(int(a), int(b)))))
+    case _:
+      raise ValueError(args)
+
+def _list_rev(particle: Particle, args: SymExpr) -> SymExpr:
+  return Lst(get_lst(args).rev())
+
+# Reads a csv file with a header line into a list of rows, each a list of its cells
+def _load_file(path: str) -> SymExpr:
+  data = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+  return Lst(PList.of(Lst(PList.of(map(Const, row))) for row in data.tolist()))
+
+# Rows pushed one at a time into a stream, instead of being read from a file
+class Feed(object):
+  def __init__(self) -> None:
+    super().__init__()
+    self.rows: Deque[List[float]] = deque()
+    self.closed: bool = False
+
+  def push(self, row: List[float]) -> None:
+    assert not self.closed
+    self.rows.append(row)
+
+  # Ends the stream once the pushed rows are read
+  def close(self) -> None:
+    self.closed = True
+
+# A csv file read lazily, one row at a time, as a list of cells shared by all particles.
+# Each cell reads its row the first time a particle needs it, so a row is only kept
+# while some particle has yet to fold over it, and rows are read as the file grows
+class Stream(object):
+  __slots__ = ('source', 'row', 'next')
+
+  def __init__(self, source: Optional[TextIO | Feed]) -> None:
+    super().__init__()
+    # Only the first unread cell holds the source
+    self.source: Optional[TextIO | Feed] = source
+    self.row: Optional[SymExpr] = None
+    self.next: Optional[Stream] = None
+
+  # Whether the row of the cell has yet to be pushed into its feed
+  def pending(self) -> bool:
+    return isinstance(self.source, Feed) and len(self.source.rows) == 0 and not self.source.closed
+
+  def _read(self) -> Optional[List[float]]:
+    match self.source:
+      case Feed(rows=rows):
+        return rows.popleft() if len(rows) > 0 else None
+      case _:
+        assert self.source is not None
+        line = self.source.readline()
+        return [float(x) for x in line.split(',')] if line.strip() else None
+
+  # Returns the row and the rest of the stream, or None at the end of the file
+  def force(self) -> Optional[Tuple[SymExpr, 'Stream']]:
+    if self.source is not None:
+      row = self._read()
+      if row is not None:
+        self.row = Const(row)
+        self.next = Stream(self.source)
+      else:
+        self.source.close()
+      self.source = None
+    if self.next is None:
+      return None
+    assert self.row is not None
+    return self.row, self.next
+
+  # Streams sent to another process send the rows read so far, and the path and position
+  # of their file to read the rest from, which is opened again in the other process
+  def __reduce__(self) -> Tuple[Any, ...]:
+    rows = []
+    cell = self
+    while cell.source is None and cell.next is not None:
+      assert cell.row is not None
+      rows.append(cell.row)
+      cell = cell.next
+    match cell.source:
+      case None:
+        position = None
+      case Feed():
+        raise ValueError('Streams fed by the caller cannot be sent to another process')
+      case f:
+        position = (f.name, f.tell())
+    return (Stream.of_rows, (rows, position))
+
+  @staticmethod
+  def of_rows(rows: List[SymExpr], position: Optional[Tuple[str, int]] = None) -> 'Stream':
+    stream = Stream(None)
+    cell = stream
+    for row in rows:
+      cell.row, cell.next = row, Stream(None)
+      cell = cell.next
+    if position is not None:
+      path, offset = position
+      cell.source = open(path, 'r')
+      cell.source.seek(offset)
+    return stream
+
+  def __str__(self) -> str:
+    return '<stream>'
+
+# Evaluation runs on the particle's stack of frames instead of the Python call stack,
+# so the evaluation depth does not depend on the length of the data being folded over.
+# A frame resumes in its context with the value of the expression evaluated above it (in particle.cont).
+# If the particle is interrupted by resample, it keeps its stack to continue from
+Resume = Callable[['Handler', Particle, Any], Optional['Code']]
+
+# Compiled form of an AST node. Either evaluates the node, leaving the value in particle.cont
+# and returning None, or pushes frames onto the stack and returns the next code to evaluate
+Code = Callable[['Handler', Particle], Optional['Code']]
+
+# Compiled form of an AST node that can be evaluated directly, without handler operations
+Value = Callable[[Particle], SymExpr]
+
+# Lowers a program once into a tree of closures, one per AST node, so each node is
+# dispatched on when compiled instead of on every evaluation.
+# The compiled program is shared by all particles and handlers
+class CompiledProgram(object):
   # file_dir is the directory of the file being evaluated, used for file operations for relative paths
-  def evaluate_particle(
+  def __init__(self, program: Program, file_dir: str) -> None:
+    super().__init__()
+    self.program: Program = program
+    self.file_dir: str = file_dir
+    self.functions: Dict[Identifier, Function[SymExpr]] = {f.name: f for f in program.functions}
+    self.purity: Dict[int, bool] = purity(program)
+    # Contents of the files read by the program, by path
+    self.files: Dict[str, SymExpr] = {}
+    # Streams opened since the handler last released them, by path
+    self.streams: Dict[str, Const] = {}
+    # Streams fed by the caller instead of read from disk, by path. They are never released,
+    # as their rows cannot be read again
+    self.feeds: Dict[str, Const] = {}
+    # Program counters of frames index the functions to resume them
+    self.resumes: List[Resume] = []
+    # Code of the compiled nodes, by id, with the node to keep its id, so nodes reached
+    # several times (as the condition and branches of an ifelse) are compiled once
+    self.codes: Dict[int, Tuple[Expr[SymExpr], Code]] = {}
+    self.function_codes: Dict[Identifier, Code] = {
+      name: self.compile(f.body) for name, f in self.functions.items()
+    }
+    self.main: Code = self.compile(program.main)
+
+  # Gets the code to evaluate the continuation of a particle
+  def code(self, cont: Expr[SymExpr]) -> Code:
+    if cont is self.program.main:
+      return self.main
+    return self.compile(cont)
+
+  # Registers the function resuming a kind of frame, returning its program counter
+  def _frame(self, resume: Resume) -> int:
+    self.resumes.append(resume)
+    return len(self.resumes) - 1
+
+  # Evaluates the particle until it is finished or interrupted by resample
+  def run(self, h: 'Handler', p: Particle) -> Particle:
+    code: Optional[Code] = self.code(p.cont)
+    p.finished = True
+    p.waiting = False
+    while True:
+      while code is not None:
+        code = code(h, p)
+
+      # Interrupted by resample or evaluated the whole program
+      if not p.finished or p.stack is None:
+        return p
+
+      pc, ctx, data, p.stack = p.stack
+      p.state.ctx = ctx
+      code = self.resumes[pc](h, p, data)
+
+  # Expressions that only use the context and operators are evaluated directly
+  def _value(self, expr: Expr[SymExpr]) -> Optional[Value]:
+    if isinstance(expr, SymExpr):
+      return lambda p: expr
+    match expr:
+      case Identifier(_, _):
+        return lambda p: p.state.ctx[expr]
+      case GenericOp(op, args):
+        f = _operator(op)
+      case Apply(func, args) if func.module is not None and not (func.module == 'List' and func.name == 'map'):
+        f = self._library(func)
+      case _:
+        return None
+
+    values = [self._value(arg) for arg in args]
+    if any(value is None for value in values):
+      return None
+    return lambda p: f(p, _convert_args([value(p) for value in values]))
+
+  def compile(self, expr: Expr[SymExpr]) -> Code:
+    compiled = self.codes.get(id(expr))
+    if compiled is None:
+      compiled = self.codes[id(expr)] = (expr, self._compile(expr))
+    return compiled[1]
+
+  def _compile(self, expr: Expr[SymExpr]) -> Code:
+    value = self._value(expr)
+    if value is not None:
+      def _return(h: 'Handler', p: Particle) -> None:
+        p.cont = value(p)
+      return _return
+
+    match expr:
+      case GenericOp(op, args):
+        return self._compile_generic_op(op, args)
+      case Fold(func, lst, acc):
+        return self._compile_fold(func, lst, acc)
+      case Apply(func, args):
+        return self._compile_apply(func, args)
+      case IfElse(cond, true, false):
+        return self._compile_ifelse(cond, true, false)
+      case Let(pattern, v, body):
+        return self._compile_let(pattern, v, body)
+      case LetRV(identifier, annotation, distribution, expression):
+        return self._compile_letrv(identifier, annotation, distribution, expression)
+      case Observe(expression, v):
+        return self._compile_observe(expression, v)
+      case Resample():
+        # Resample interrupts the evalution
+        def _resample(h: 'Handler', p: Particle) -> None:
+          h.resample(p)
+        return _resample
+      case _:
+        raise ValueError(expr)
+
+  # Evaluates arguments, from left to right, starting from the i-th argument with the
+  # values of the previous arguments, then calls finish with the values of all the arguments
+  def _compile_args(
     self,
-    particle: Particle, 
-    functions: Dict[Identifier, Function[SymExpr]], 
-    file_dir: str,
-  ) -> Particle:
-    # Evaluates arguments, from left to right. Returning the particle, the remaining arguments, and the evaluated arguments
-    # If an argument is not finished, the particle is returned with the remaining arguments
-    def _evaluate_args(particle: Particle, 
-                      args: List[Expr[SymExpr]], 
-                      new_args: List[SymExpr]) -> Tuple[Particle, List[Expr[SymExpr]], List[SymExpr]]:
-      if len(args) == 0:
-        return particle, args, new_args
-      p1 = _evaluate(particle.update(cont=args[0]))
-      if not p1.finished:
-        args[0] = p1.cont
-        return p1, args, new_args
-      new_args.append(p1.final_expr)
-      return _evaluate_args(p1, args[1:], new_args)
-
-    # Evaluate built-in operators
-    def _evaluate_ops(particle: Particle, op: Operator, args: SymExpr) -> Particle:
-      def _evaluate_unops(particle: Particle, constructor: Any, args: SymExpr) -> Particle:
-        return particle.update(cont=constructor(args), finished=True)
-
-      def _evaluate_binops(particle: Particle, constructor: Any, args: SymExpr) -> Particle:
-        fst, snd = get_pair(args)
-        return particle.update(cont=constructor(fst, snd), finished=True)
-        
-      def _evaluate_triops(particle: Particle, constructor: Any, args: SymExpr) -> Particle:
-        fst, args2 = get_pair(args)
-        snd, trd = get_pair(args2)
-        return particle.update(cont=constructor(fst, snd, trd), finished=True)
-          
-      # Map to the correct operator
-      match op.name:
-        case "add":
-          return _evaluate_binops(particle, Add, args)
-        case "sub":
-          # a - b = a + (-1 * b)
-          return _evaluate_binops(particle, lambda fst,snd: Add(fst, Mul(Const(-1), snd)), args)
-        case "mul":
-          return _evaluate_binops(particle, Mul, args)
-        case "div":
-          return _evaluate_binops(particle, Div, args)
-        case "eq":
-          return _evaluate_binops(particle, Eq, args)
-        case "lt":
-          return _evaluate_binops(particle, Lt, args)
-        case "cons":
-          return _evaluate_binops(particle, lambda fst,snd: Lst([fst] + get_lst(snd)), args)
-        case "lst":
-          # Empty list is considered a Constant
-          def _make_list(x):
-            if isinstance(x, Const):
-              if x.v is None:
-                return Const([])
-            return Lst([x])
-          return _evaluate_unops(particle, _make_list, args)
-        case "pair":
-          return _evaluate_binops(particle, Pair, args)
-        case "gaussian":
-          return _evaluate_binops(particle, Normal, args)
-        case "beta":
-          return _evaluate_binops(particle, Beta, args)
-        case "bernoulli":
-          return _evaluate_unops(particle, Bernoulli, args)
-        case "binomial":
-          return _evaluate_binops(particle, Binomial, args)
-        case "beta_binomial":
-          return _evaluate_triops(particle, BetaBinomial, args)
-        case "negative_binomial":
-          return _evaluate_binops(particle, NegativeBinomial, args)
-        case "exponential":
-          # Exponential is a special case of Gamma
-          # Represented as a Gamma so can be detected when applying 
-          # conjugacy rules
-          return _evaluate_binops(particle, Gamma, Pair(Const(1.0), args))
-        case "gamma":
-          return _evaluate_binops(particle, Gamma, args)
-        case "poisson":
-          return _evaluate_unops(particle, Poisson, args)
-        case "delta":
-          return _evaluate_unops(particle, Delta, args)
-        case "categorical":
-          return _evaluate_triops(particle, Categorical, args)
-        case "uniform_int":
-          a, b = get_pair(args)
-          # For now, uniform only takes constants
-          # [a, b]
-          # Represented as a categorical distribution
-          match (particle.state.eval(a), particle.state.eval(b)):
-            case (Const(a), Const(b)):
-              assert isinstance(a, Number) and isinstance(b, Number)\
-                and round(a) == a and round(b) == b and a <= b
-              a, b = int(a), int(b)
-              probs = Const(list(np.ones(b - a + 1) / (b - a + 1)))
-              return _evaluate_ops(particle, Operator.categorical, 
-                                    Pair(Const(a), Pair(Const(b), probs)))
-            case _:
-              raise ValueError(args)
-        case "student_t":
-          return _evaluate_triops(particle, StudentT, args)
+    args: List[Expr[SymExpr]],
+    finish: Callable[['Handler', Particle, Tuple[SymExpr, ...]], Optional[Code]],
+  ) -> Callable[['Handler', Particle, int, Tuple[SymExpr, ...]], Optional[Code]]:
+    steps = [(value, None if value is not None else self.compile(arg))
+              for arg, value in ((arg, self._value(arg)) for arg in args)]
+
+    def _evaluate_args(h: 'Handler', p: Particle, i: int, values: Tuple[SymExpr, ...]) -> Optional[Code]:
+      while i < len(steps):
+        value, code = steps[i]
+        if value is None:
+          p.stack = (pc, p.state.ctx, (i, values), p.stack)
+          return code
+        values += (value(p),)
+        i += 1
+      return finish(h, p, values)
+
+    def _next(h: 'Handler', p: Particle, data: Tuple[int, Tuple[SymExpr, ...]]) -> Optional[Code]:
+      i, values = data
+      return _evaluate_args(h, p, i + 1, values + (p.cont,))
+
+    pc = self._frame(_next)
+    return _evaluate_args
+
+  def _compile_generic_op(self, op: Operator, args: List[Expr[SymExpr]]) -> Code:
+    apply_op = _operator(op)
+
+    def _generic_op(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> None:
+      p.cont = apply_op(p, _convert_args(values))
+
+    evaluate_args = self._compile_args(args, _generic_op)
+    return lambda h, p: evaluate_args(h, p, 0, ())
+
+  # Library functions, which only take symbolic expressions as arguments
+  def _library(self, func: Identifier) -> Callable[[Particle, SymExpr], SymExpr]:
+    match func.module, func.name:
+      case 'List', 'hd':
+        return _list_hd
+      case 'List', 'tl':
+        return _list_tl
+      case 'List', 'len':
+        return _list_len
+      case 'List', 'range':
+        return _list_range
+      case 'List', 'rev':
+        return _list_rev
+      case 'File', 'read':
+        return self._file_read
+      case 'File', 'stream':
+        return self._file_stream
+      case _:
+        raise ValueError(func)
+
+  # File operations only take constants as arguments
+  def _file_path(self, args: SymExpr) -> str:
+    match args:
+      case Const(filename):
+        if os.path.isabs(filename):
+          return filename
+        else:
+          return os.path.join(self.file_dir, filename)
+      case _:
+        raise ValueError(args)
+
+  def _file_read(self, particle: Particle, args: SymExpr) -> SymExpr:
+    path = self._file_path(args)
+    # Each file is read once and its list of rows is shared by all particles
+    data = self.files.get(path)
+    if data is None:
+      data = _load_file(path)
+      self.files[path] = data
+    return data
+
+  def _file_stream(self, particle: Particle, args: SymExpr) -> SymExpr:
+    path = self._file_path(args)
+    # Particles opening the stream before it is released share its reader
+    stream = self.streams.get(path)
+    if stream is None:
+      f = open(path, 'r')
+      # Skip the header
+      f.readline()
+      stream = Const(Stream(f))
+      self.streams[path] = stream
+    return stream
+
+  # Opens the stream of a file to be fed rows instead of reading it
+  def feed(self, filename: str) -> Feed:
+    path = self._file_path(Const(filename))
+    feed = Feed()
+    self.feeds[path] = self.streams[path] = Const(Stream(feed))
+    return feed
+
+  # Forgets the opened streams, so rows read by all the particles holding them can be freed
+  def release_streams(self) -> None:
+    self.streams = {**self.feeds}
+
+  # Calls a function on already evaluated arguments
+  def _compile_call(self, func: Identifier) -> Callable[['Handler', Particle, SymExpr], Optional[Code]]:
+    if func.module is not None:
+      f = self._library(func)
+      def _library_call(h: 'Handler', p: Particle, args: SymExpr) -> None:
+        p.cont = f(p, args)
+      return _library_call
+
+    # The function returns to a frame which restores its own context,
+    # so calls do not need to push a frame
+    def _call(h: 'Handler', p: Particle, args: SymExpr) -> Code:
+      p.state.ctx = match_pattern(self.functions[func].args, args)
+      return self.function_codes[func]
+    return _call
+
+  def _compile_apply(self, func: Identifier, args: List[Expr[SymExpr]]) -> Code:
+    if func.module == 'List' and func.name == 'map':
+      return self._compile_map(func, args)
+
+    call = self._compile_call(func)
+
+    def _apply(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> Optional[Code]:
+      return call(h, p, _convert_args(values))
+
+    evaluate_args = self._compile_args(args, _apply)
+    return lambda h, p: evaluate_args(h, p, 0, ())
+
+  # Map calls the function on each element of the list, from first to last
+  def _compile_map(self, func: Identifier, args: List[Expr[SymExpr]]) -> Code:
+    map_func = args[0]
+    assert isinstance(map_func, Identifier)
+    call = self._compile_call(map_func)
+
+    # The values are kept as a linked list, in reverse order, so frames can share them
+    def _map_step(h: 'Handler', p: Particle, exprs: PList[SymExpr], values: Any) -> Optional[Code]:
+      if len(exprs) == 0:
+        l = PList.empty
+        while values is not None:
+          v, values = values
+          l = l.cons(v)
+        p.cont = Lst(l)
+        return None
+      p.stack = (pc, p.state.ctx, (exprs.tail, values), p.stack)
+      return call(h, p, exprs.head)
+
+    def _next(h: 'Handler', p: Particle, data: Tuple[PList[SymExpr], Any]) -> Optional[Code]:
+      exprs, values = data
+      return _map_step(h, p, exprs, (p.cont, values))
+
+    def _map(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> Optional[Code]:
+      return _map_step(h, p, get_lst(_convert_args(values)), None)
+
+    pc = self._frame(_next)
+    evaluate_args = self._compile_args(args[1:], _map)
+    return lambda h, p: evaluate_args(h, p, 0, ())
+
+  def _compile_fold(self, func: Identifier, lst: Expr[SymExpr], acc: Expr[SymExpr]) -> Code:
+    call = self._compile_call(func)
+
+    # It's a bounded loop, calling the function on each element of the list,
+    # keeping a frame with the rest of the list to continue from
+    def _fold_step(h: 'Handler', p: Particle, exprs: PList[SymExpr], acc_val: SymExpr) -> Optional[Code]:
+      if len(exprs) == 0:
+        p.cont = acc_val
+        return None
+      p.stack = (pc, p.state.ctx, exprs.tail, p.stack)
+      return call(h, p, Pair(exprs.head, acc_val))
+
+    def _next(h: 'Handler', p: Particle, exprs: PList[SymExpr]) -> Optional[Code]:
+      return _fold_step(h, p, exprs, p.cont)
+
+    # Streams are folded over lazily, keeping a frame with the rest of the stream
+    def _stream_step(h: 'Handler', p: Particle, stream: Stream, acc_val: SymExpr) -> Optional[Code]:
+      if stream.pending():
+        # Waits for the row to be fed, interrupting the particle without resampling it
+        p.stack = (stream_pc, p.state.ctx, stream, p.stack)
+        p.update(cont=acc_val, finished=False)
+        p.waiting = True
+        return None
+      cell = stream.force()
+      if cell is None:
+        p.cont = acc_val
+        return None
+      row, rest = cell
+      p.stack = (stream_pc, p.state.ctx, rest, p.stack)
+      return call(h, p, Pair(row, acc_val))
+
+    def _next_row(h: 'Handler', p: Particle, rest: Stream) -> Optional[Code]:
+      return _stream_step(h, p, rest, p.cont)
+
+    def _fold(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> Optional[Code]:
+      lst_val, acc_val = values
+      match lst_val:
+        case Lst(exprs):
+          return _fold_step(h, p, exprs, acc_val)
+        case Const(Stream() as stream):
+          return _stream_step(h, p, stream, acc_val)
         case _:
-          raise ValueError(op.name)
-        
-    # Args can be a list of expressions, so need to extract them 
-    # if only a single argument (or none)
-    def _convert_args(args: List[SymExpr]) -> SymExpr:
-      if len(args) == 0:
-        return Const(None)
-      elif len(args) == 1:
-        return args[0]
+          raise ValueError(lst_val)
+
+    pc = self._frame(_next)
+    stream_pc = self._frame(_next_row)
+    evaluate_args = self._compile_args([lst, acc], _fold)
+    return lambda h, p: evaluate_args(h, p, 0, ())
+
+  def _compile_ifelse(self, cond: Expr[SymExpr], true: Expr[SymExpr], false: Expr[SymExpr]) -> Code:
+    true_code = self.compile(true)
+    false_code = self.compile(false)
+
+    def _ite(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> None:
+      cond_val, then_val, else_val = values
+      p.cont = p.state.ex_ite(cond_val, then_val, else_val)
+
+    # Continues from the evaluated condition
+    evaluate_branches = self._compile_args([cond, true, false], _ite)
+    branches_pure = self.purity[id(true)] and self.purity[id(false)]
+
+    def _branch(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> Optional[Code]:
+      cond_val, = values
+      # If both branches are pure, evaluate them and represent as ite symbolic expression
+      if len(cond_val.rvs()) > 0 and branches_pure:
+        return evaluate_branches(h, p, 1, values)
       else:
-        return Pair(args[0], _convert_args(args[1:]))
+        # If not pure, fully evaluate the condition, sampling RVs if necessary,
+        # and then evaluate only the branch that is taken
+        cond_value = p.state.value_expr(cond_val)
+        match cond_value:
+          case Const(v):
+            if v:
+              return true_code
+            else:
+              return false_code
+          case _:
+            raise ValueError(cond_value)
+
+    evaluate_cond = self._compile_args([cond], _branch)
+    return lambda h, p: evaluate_cond(h, p, 0, ())
+
+  # The body of a let is evaluated with the pattern bound to the value and returns to
+  # the frame below, which restores its own context
+  def _compile_let(self, pattern: List[Any], v: Expr[SymExpr], body: Expr[SymExpr]) -> Code:
+    body_code = self.compile(body)
+
+    def _bind(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> Code:
+      val, = values
+      p.state.ctx |= match_pattern(pattern, val)
+      return body_code
+
+    evaluate_args = self._compile_args([v], _bind)
+    return lambda h, p: evaluate_args(h, p, 0, ())
+
+  def _compile_letrv(self, identifier: Identifier, annotation: Optional[Annotation],
+                     distribution: Op[SymExpr], expression: Expr[SymExpr]) -> Code:
+    body_code = self.compile(expression)
+    assert identifier.name is not None # RVs should always be named
+
+    def _letrv(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> Code:
+      distribution, = values
+      assert isinstance(distribution, Op)
+      rv = h.assume(p, identifier, annotation, distribution)
+      # After creating the RV, it is just a let expression
+      p.state.ctx |= match_pattern([identifier], rv)
+      return body_code
+
+    evaluate_args = self._compile_args([distribution], _letrv)
+    return lambda h, p: evaluate_args(h, p, 0, ())
+
+  def _compile_observe(self, expression: Op[SymExpr], v: Expr[SymExpr]) -> Code:
+    def _observe(h: 'Handler', p: Particle, values: Tuple[SymExpr, ...]) -> None:
+      d, val = values
+      assert isinstance(d, Op)
+      # Update the particle with the new score
+      p.update(cont=val, score=h.observe(p, p.score, d, val))
+
+    evaluate_args = self._compile_args([expression, v], _observe)
+    return lambda h, p: evaluate_args(h, p, 0, ())
+
+P = ParamSpec("P")
+
+class Handler(object):
+  # Evaluates a single particle, returning an evaluated particle 
+  # or a particle with the next expression to evaluate if interrupted by resample
+  def evaluate_particle(self, particle: Particle, program: CompiledProgram) -> Particle:
+    return program.run(self, particle)
     
-    # Evaluate list operations. Evaluates arguments first, interrupting if args did not finish evaluation
-    def _evaluate_list(particle: Particle, func: Identifier, args: List[Expr[SymExpr]]) -> Particle:
-      assert func.module == 'List'
-      match func.name:
-        case 'hd':
-          (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-          if len(old_args) != 0:
-            return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          
-          exprs = get_lst(new_args)
-          if len(exprs) == 0:
-            raise ValueError(new_args)
-          return p1.update(cont=exprs[0], finished=True)
-        case 'tl':
-          (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-          if len(old_args) != 0:
-            return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          
-          exprs = get_lst(new_args)
-          if len(exprs) == 0:
-            raise ValueError(new_args)
-          return p1.update(cont=Lst(exprs[1:]), finished=True)
-        case 'len':
-          (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-          if len(old_args) != 0:
-            return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          
-          exprs = get_lst(new_args)
-          return p1.update(cont=Const(len(exprs)), finished=True)
-        case 'range':
-          (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-          if len(old_args) != 0:
-            return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          
-          # Range only takes constants
-          a, b = get_pair(new_args)
-          match p1.state.eval(a), p1.state.eval(b):
-            case Const(a), Const(b):
-              assert isinstance(a, Number) and isinstance(b, Number) and a <= b
-              l : List[SymExpr] = list(map(Const, range(int(a), int(b))))
-              return p1.update(cont=Lst(l), finished=True)
-            case _:
-              raise ValueError(new_args)
-        case 'rev':
-          (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-          if len(old_args) != 0:
-            return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          
-          exprs = get_lst(new_args)
-          return p1.update(cont=Lst(exprs[::-1]), finished=True)
-        case 'map':
-          map_func = args[0]
-          assert isinstance(map_func, Identifier)
-
-          (p1, old_args, new_args) = _evaluate_args(particle, args[1:], [])
-          if len(old_args) != 0:
-            return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          
-          # Map is syntactic sugar of a list, calling the function on each element
-          exprs = get_lst(new_args)
-          new_e = Lst([])
-          for e in exprs[::-1]:
-            new_e = GenericOp(Operator.cons, [
-              Apply(map_func, [e]),
-              new_e,
-            ])
-          return _evaluate(p1.update(cont=new_e))
-        case _:
-          raise ValueError(func)
-        
-    # Evaluate file operations. These only take constants as arguments
-    def _evaluate_file(particle: Particle, func: Identifier, args: List[Expr[SymExpr]]) -> Particle:
-      assert func.module == 'File'
-      match func.name:
-        case 'read':
-          (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-          if len(old_args) != 0:
-            return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          
-          match new_args:
-            case Const(filename):
-              if os.path.isabs(filename):
-                path = filename
-              else:
-                path = os.path.join(file_dir, filename)
-              data = []
-              with open(path, 'r') as f:
-                lines = f.readlines()
-                for line in lines[1:]:
-                  line_list = line.strip().split(',')
-                  line_list = list(map(lambda x: float(x), line_list))
-                  data.append(line_list)
-              return p1.update(cont=Const(data), finished=True)
-            case _:
-              raise ValueError(new_args)
-        case _:
-          raise ValueError(func)
-
-    # Evaluate the particle, returning an evaluated particle 
-    # or a particle with the next expression to evaluate if interrupted by resample
-    def _evaluate(particle: Particle) -> Particle:
-      if isinstance(particle.cont, SymExpr):
-        return particle.update(finished=True)
-      match particle.cont:
-        case Identifier(_, _):
-          return particle.update(cont=particle.state.ctx[particle.cont], finished=True)
-        case GenericOp(op, args):
-          (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-          if len(old_args) != 0:
-            return p1.update(cont=GenericOp(op, old_args + new_args), finished=False)
-          new_args = _convert_args(new_args)
-          return _evaluate_ops(p1, op, new_args)
-        case Fold(func, lst, acc):
-          # Fold is syntactic sugar for a chain of let expressions
-          # It's a bounded loop
-          p1 = _evaluate(particle.update(cont=lst))
-          if not p1.finished:
-            return p1.update(cont=Fold(func, p1.cont, acc), finished=False)
-          lst_val = p1.final_expr
-          
-          p2 = _evaluate(p1.update(cont=acc))
-          if not p2.finished:
-            return p2.update(cont=Fold(func, lst_val, p2.cont), finished=False)
-          acc_val = p2.final_expr
-          match lst_val:
-            case Lst(exprs):
-              if len(exprs) == 0:
-                return p2.update(cont=acc_val, finished=True)
-              else:
-                hd, tl = exprs[0], exprs[1:]
-                # Create a temporary variable to store the result of the function
-                tempvar = p2.state.ctx.temp_var()
-                e = Let([tempvar], 
-                        Apply(func, [hd, acc_val]), 
-                        Fold(func, Lst(tl), tempvar))
-                return _evaluate(p2.update(cont=e))
-            case _:
-              raise ValueError(p1.cont)
-        case Apply(func, args):
-          if func.module is not None:
-            # use lib functions
-            match func.module:
-              case "List":
-                return _evaluate_list(particle, func, args)
-              case "File":
-                return _evaluate_file(particle, func, args)
-              case _:
-                raise ValueError(func.module)
-          else:
-            (p1, old_args, new_args) = _evaluate_args(particle, args, [])
-            if len(old_args) != 0:
-              return p1.update(cont=Apply(func, old_args + new_args), finished=False)
-            converted_args = _convert_args(new_args)
-            function = functions[func]
-            ctx = copy(p1.state.ctx)
-            p1.state.ctx = match_pattern(function.args, converted_args)
-            p2 = _evaluate(p1.update(cont=function.body))
-            if not p2.finished:
-              # for every variable assigned during evaluation, add it as let expression
-              # because need to roll back the context
-              e = p2.cont
-              for k in p2.state.ctx:
-                if k not in ctx or ctx[k] != p2.state.ctx[k]:
-                  e = Let([k], p2.state.ctx[k], e)
-              
-              p2.state.ctx = ctx
-              return p2.update(cont=e, finished=False)
-            p2.state.ctx = ctx
-            return p2
-        case IfElse(cond, true, false):
-          p1 = _evaluate(particle.update(cont=cond))
-          if not p1.finished:
-            return p1.update(cont=IfElse(p1.cont, true, false), finished=False)
-          cond_val = p1.final_expr
-          
-          # If both branches are pure, evaluate them and represent as ite symbolic expression
-          if len(cond_val.rvs()) > 0 and pure(true, functions) and pure(false, functions):
-            p2 = _evaluate(p1.update(cont=true))
-            if not p2.finished:
-              return p2.update(cont=IfElse(cond_val, p2.cont, false), finished=False)
-            then_val = p2.final_expr
-            p3 = _evaluate(p2.update(cont=false))
-            if not p3.finished:
-              return p3.update(cont=IfElse(p1.cont, p2.cont, p3.cont), finished=False)
-            return p3.update(cont=p3.state.ex_ite(cond_val, then_val, p3.final_expr), finished=True)
-          else:
-            # If not pure, fully evaluate the condition, sampling RVs if necessary, 
-            # and then evaluate only the branch that is taken
-            cond_value = p1.state.value_expr(p1.final_expr)
-            match cond_value:
-              case Const(v):
-                if v:
-                  return _evaluate(p1.update(cont=true))
-                else:
-                  return _evaluate(p1.update(cont=false))
-              case _:
-                raise ValueError(cond_value)
-        case Let(pattern, v, body):
-          ctx = copy(particle.state.ctx)
-          p1 = _evaluate(particle.update(cont=v))
-          if not p1.finished:
-            return p1.update(cont=Let(pattern, p1.cont, body), finished=False)
-          val = p1.final_expr
-          p1.state.ctx |= match_pattern(pattern, val)
-          p2 = _evaluate(p1.update(cont=body))
-          # If the body is finished, restore the original context
-          if p2.finished:
-            p2.state.ctx = ctx
-          return p2
-        case LetRV(identifier, annotation, distribution, expression):
-          p1 = _evaluate(particle.update(cont=distribution))
-          assert isinstance(p1.cont, Op) # should still be an Op even if not finished
-          if not p1.finished:
-            return p1.update(cont=LetRV(identifier, annotation, p1.cont, expression), finished=False)
-          assert identifier.name is not None # RVs should always be named
-          rv = self.assume(p1, identifier, annotation, p1.final_expr)
-          # After creating the RV, it is just a let expression
-          return _evaluate(p1.update(cont=Let([identifier], rv, expression)))
-        case Observe(expression, v):
-          p1 = _evaluate(particle.update(cont=expression))
-          assert isinstance(p1.cont, Op) # should still be an Op even if not finished
-          if not p1.finished:
-            return p1.update(cont=Observe(p1.cont, v), finished=False)
-          d = p1.final_expr
-          assert isinstance(d, Op) # should still be an Op 
-          p2 = _evaluate(p1.update(cont=v))
-          if not p2.finished:
-            return p2.update(cont=Observe(d, p2.cont), finished=False)
-          w = self.observe(p2, p2.score, d, p2.final_expr)
-          # Update the particle with the new score
-          return p2.update(score=w)
-        case Resample():
-          # Resample interrupts the evalution
-          return self.resample(particle)
-        case _:
-          raise ValueError(particle.cont)
-        
-    return _evaluate(particle)
     
   def assume(self, particle: Particle, name: Identifier, annotation: Optional[Annotation], distribution: SymExpr) -> Const | RandomVar:
     raise NotImplementedError
@@ -451,6 +701,10 @@ class Handler(object):
   ) -> Tuple[SymExpr, ProbState]:
     raise NotImplementedError
 
+# Module level, so that states can be sent to other processes
+def _value_impl(state: SymState) -> Callable[[RandomVar], Const]:
+  return state.value_impl
+
 class SMC(Handler):
     
   def assume(self, particle: Particle, name: Identifier, annotation: Optional[Annotation], distribution: SymExpr) -> Const | RandomVar:
@@ -464,7 +718,7 @@ class SMC(Handler):
   
   # creates wrapper for doing value
   def value(self) -> Callable[[SymState], Callable[[RandomVar], Const]]:
-    return lambda state: state.value_impl
+    return _value_impl
 
   def observe(self, particle: Particle, score: float, distribution: SymExpr, v: SymExpr) -> float:
     assert isinstance(distribution, SymDistr)
@@ -486,30 +740,294 @@ class SMC(Handler):
     seed: Optional[int] = None, 
     **kwargs: P.kwargs,
   ) -> Tuple[SymExpr, ProbState]:
-    functions, expression = program.functions, program.main
-
-    # Make lookup for functions
-    functions = {f.name: f for f in functions}
+    # Compile the program once, shared by all particles
+    compiled = CompiledProgram(program, file_dir)
+    expression = program.main
 
     n_particles = kwargs.get("n_particles", 1)
+    resampling = kwargs.get("resampling", "multinomial")
+    ess_threshold = kwargs.get("ess_threshold", None)
+    compress = kwargs.get("compress", False)
+    gc_growth = kwargs.get("gc_growth", 2.)
+    n_jobs = min(kwargs.get("n_jobs", 1), n_particles)
+    if compress and n_jobs > 1:
+      raise ValueError("Particles cannot be compressed when evaluated by several jobs")
 
     # Initialize particles
-    particles = ProbState(n_particles, expression, method, self.value(), seed)
+    particles = ProbState(n_particles, expression, method, self.value(), seed, resampling, ess_threshold, compress, gc_growth)
+    if n_jobs > 1:
+      # The particles are evaluated by the workers, and only their scores are kept here
+      pool = ParticlePool(program, method, file_dir, particles.particle_seed, n_particles, n_jobs, gc_growth)
+      try:
+        while not particles.finished:
+          pool.step(particles)
+        particles.particles = pool.collect()
+      finally:
+        pool.close()
+      return particles.result(), particles
+
     # Evaluate particles until all are finished
-    while True:
-      for i, particle in enumerate(particles):
-        if particle.finished:
-          continue
-        else:
-          particles[i] = self.evaluate_particle(particle, functions, file_dir)
+    while not particles.finished:
+      self.step(particles, compiled)
 
-      # If not all particles are finished, resample the particles
-      if particles.finished:
-        break
+    return particles.result(), particles
+
+  # Evaluates a particle standing for several particles once. If evaluation draws a
+  # value, the particles diverge, so the others are evaluated on their own from the start
+  def evaluate_copies(self, particle: Particle, program: CompiledProgram) -> List[Particle]:
+    count = particle.count
+    start = copy(particle)
+    draws = particle.state.draws
+    particle = self.evaluate_particle(particle, program)
+    if particle.state.draws == draws:
+      return [particle]
+
+    particle.count = 1
+    copies = [particle]
+    for i in range(count - 1):
+      p = copy(start) if i < count - 2 else start
+      p.count = 1
+      copies.append(self.evaluate_particle(p, program))
+    return copies
+
+  # Evaluates the particles until they are all interrupted or finished
+  def step(self, particles: ProbState, compiled: CompiledProgram) -> ProbState:
+    new_particles = []
+    for particle in particles:
+      if particle.finished:
+        new_particles.append(particle)
+      elif particle.count > 1:
+        new_particles.extend(self.evaluate_copies(particle, compiled))
       else:
+        new_particles.append(self.evaluate_particle(particle, compiled))
+    particles.particles = new_particles
+    # All particles reached the same point, so streams opened since are held by them
+    compiled.release_streams()
+
+    # If not all particles are finished, collect what they cannot reach and resample them
+    # (unless their effective sample size is still above the threshold, or they are only
+    # waiting for rows to be fed)
+    if not particles.finished:
+      particles.merge_encodings()
+      particles.collect()
+      if not particles.waiting and particles.should_resample():
         particles.resample()
+    return particles
 
-    return particles.result(), particles
+# SMC evaluating all the particles at once, each constant holding the values of all
+# the particles. Falls back to SMC if the particles do not evaluate the same way
+class VectorizedSMC(SMC):
+  def infer(
+    self,
+    program: Program,
+    method: type[SymState],
+    file_dir: str,
+    seed: Optional[int] = None,
+    **kwargs: P.kwargs,
+  ) -> Tuple[SymExpr, ProbState]:
+    # The particles are evaluated at once, so they are neither split between jobs nor compressed
+    if kwargs.get("n_jobs", 1) > 1 or kwargs.get("compress", False):
+      raise ValueError("Vectorized SMC does not support n_jobs or compress")
+
+    compiled = CompiledProgram(program, file_dir)
+    n_particles = kwargs.get("n_particles", 1)
+    resampling = kwargs.get("resampling", "multinomial")
+    ess_threshold = kwargs.get("ess_threshold", None)
+    gc_growth = kwargs.get("gc_growth", 2.)
+
+    particles = VectorizedProbState(n_particles, program.main, method, self.value(), seed, resampling, ess_threshold, gc_growth)
+    try:
+      while not particles.finished:
+        self.step(particles, compiled)
+      return particles.result(), particles
+    except Divergence as e:
+      warnings.warn(f"Particles cannot be vectorized, falling back to SMC: {e!r}")
+    finally:
+      compiled.release_streams()
+    return super().infer(program, method, file_dir, seed, **kwargs)
+
+# Worker process evaluating a shard of the particles of SMC, on requests from a ParticlePool.
+# The particles draw from the stream of their index in the ProbState, as they would in SMC
+def _pool_worker(
+  conn: Connection,
+  program: Program,
+  method: type[SymState],
+  file_dir: str,
+  seed: np.random.SeedSequence,
+  slots: List[int],
+  gc_growth: Optional[float],
+) -> None:
+  handler = SMC()
+  compiled = CompiledProgram(program, file_dir)
+  particles = ProbState(len(slots), program.main, method, handler.value(), gc_growth=gc_growth)
+  for particle, slot in zip(particles, slots):
+    particle.state.reseed(particle_seed(seed, 0, slot))
+  while True:
+    request = conn.recv()
+    try:
+      match request:
+        case ('step',):
+          for i, particle in enumerate(particles):
+            if not particle.finished:
+              particles[i] = handler.evaluate_particle(particle, compiled)
+          compiled.release_streams()
+          particles.collect()
+          conn.send([(p.score, p.finished, p.state.encodings) for p in particles])
+        case ('export', idxs):
+          conn.send([particles[i] for i in idxs])
+        case ('import', idxs, migrants, generation, slots):
+          # The first occurrence of each particle is kept, the others are copies
+          used = set()
+          new_particles = []
+          for particle in [particles[i] for i in idxs] + migrants:
+            new_particles.append(particle if id(particle) not in used else copy(particle))
+            used.add(id(particle))
+          for particle, slot in zip(new_particles, slots):
+            particle.update(score=0.)
+            particle.state.reseed(particle_seed(seed, generation, slot))
+          particles.particles = new_particles
+          conn.send(None)
+        case ('collect',):
+          conn.send(particles.particles)
+        case ('close',):
+          conn.close()
+          return
+        case _:
+          raise ValueError(request)
+    except Exception as e:
+      conn.send(e)
+
+# Particles of SMC split in shards, each evaluated by a worker process. The workers keep
+# their particles between resample points, and only the particles resampled more times
+# than their worker has room for move to another worker
+class ParticlePool(object):
+  def __init__(
+    self,
+    program: Program,
+    method: type[SymState],
+    file_dir: str,
+    seed: np.random.SeedSequence,
+    n_particles: int,
+    n_jobs: int,
+    gc_growth: Optional[float] = 2.,
+  ) -> None:
+    super().__init__()
+    # Indices in the ProbState of the particles of each worker
+    offsets = np.linspace(0, n_particles, n_jobs + 1).astype(int)
+    self.slots: List[List[int]] = [list(range(offsets[w], offsets[w + 1])) for w in range(n_jobs)]
+    self.conns: List[Connection] = []
+    self.workers: List[Process] = []
+    for w in range(n_jobs):
+      conn, worker_conn = Pipe()
+      worker = Process(
+        target=_pool_worker,
+        args=(worker_conn, program, method, file_dir, seed, self.slots[w], gc_growth),
+        daemon=True,
+      )
+      worker.start()
+      self.conns.append(conn)
+      self.workers.append(worker)
+
+  def _request(self, requests: Dict[int, Tuple[Any, ...]]) -> Dict[int, Any]:
+    for w, request in requests.items():
+      self.conns[w].send(request)
+    replies = {w: self.conns[w].recv() for w in requests}
+    for reply in replies.values():
+      if isinstance(reply, Exception):
+        raise reply
+    return replies
+
+  # Evaluates the particles until they are all interrupted or finished, as SMC.step,
+  # updating the scores and encodings of the given particles
+  def step(self, particles: ProbState) -> ProbState:
+    replies = self._request({w: ('step',) for w in range(len(self.conns))})
+    for w, reply in replies.items():
+      for slot, (score, finished, encodings) in zip(self.slots[w], reply):
+        particles[slot].update(score=score, finished=finished)
+        particles[slot].state.encodings = encodings
+
+    if not particles.finished:
+      particles.merge_encodings()
+    if not particles.finished and particles.should_resample():
+      particles.generation += 1
+      self.resample(particles.resample_indices(len(particles)), particles.generation)
+      for p in particles:
+        p.update(score=0.)
+    return particles
+
+  # Keeps the particles at the given indices, in the worker of each particle if it has room
+  def resample(self, idxs: np.ndarray, generation: int) -> None:
+    n_jobs = len(self.conns)
+    location = {slot: (w, i) for w, slots in enumerate(self.slots) for i, slot in enumerate(slots)}
+    # Indices in the worker of the particles to keep, with their new indices in the ProbState
+    kept: List[List[Tuple[int, int]]] = [[] for _ in range(n_jobs)]
+    surplus: List[List[Tuple[int, int]]] = [[] for _ in range(n_jobs)]
+    for new_slot, idx in enumerate(idxs):
+      w, i = location[idx]
+      (kept if len(kept[w]) < len(self.slots[w]) else surplus)[w].append((i, new_slot))
+
+    exported = self._request({
+      w: ('export', [i for i, _ in surplus[w]]) for w in range(n_jobs) if len(surplus[w]) > 0
+    })
+    migrants = [(new_slot, particle)
+                for w in exported for (_, new_slot), particle in zip(surplus[w], exported[w])]
+    requests = {}
+    for w in range(n_jobs):
+      room = len(self.slots[w]) - len(kept[w])
+      moved, migrants = migrants[:room], migrants[room:]
+      self.slots[w] = [new_slot for _, new_slot in kept[w]] + [new_slot for new_slot, _ in moved]
+      requests[w] = ('import', [i for i, _ in kept[w]], [p for _, p in moved], generation, self.slots[w])
+    self._request(requests)
+
+  # Gathers the particles of all workers, in the order of the ProbState
+  def collect(self) -> List[Particle]:
+    replies = self._request({w: ('collect',) for w in range(len(self.conns))})
+    particles: List[Particle] = [None] * sum(map(len, self.slots))  # type: ignore
+    for w, reply in replies.items():
+      for slot, particle in zip(self.slots[w], reply):
+        particles[slot] = particle
+    return particles
+
+  def close(self) -> None:
+    for conn, worker in zip(self.conns, self.workers):
+      conn.send(('close',))
+      worker.join()
+
+# Runs SMC online, on a program folding over File.stream(filename) where the rows are
+# pushed one at a time instead of read from the file. The particles are kept between
+# rows, so each row only advances them to their next resample
+class Filter(object):
+  def __init__(
+    self,
+    program: Program,
+    method: type[SymState],
+    file_dir: str,
+    filename: str,
+    seed: Optional[int] = None,
+    n_particles: int = 1,
+    resampling: str = 'multinomial',
+    ess_threshold: Optional[float] = None,
+    compress: bool = False,
+    gc_growth: Optional[float] = 2.,
+  ) -> None:
+    super().__init__()
+    self.handler: SMC = SMC()
+    self.compiled: CompiledProgram = CompiledProgram(program, file_dir)
+    self.feed: Feed = self.compiled.feed(filename)
+    self.particles: ProbState = ProbState(
+      n_particles, program.main, method, self.handler.value(), seed, resampling, ess_threshold, compress, gc_growth)
+
+  # Pushes a row and advances the particles, returning them to query the posterior
+  def step(self, row: List[float]) -> ProbState:
+    self.feed.push(row)
+    return self.handler.step(self.particles, self.compiled)
+
+  # Ends the stream and runs the particles to the end of the program
+  def close(self) -> Tuple[SymExpr, ProbState]:
+    self.feed.close()
+    while not self.particles.finished:
+      self.handler.step(self.particles, self.compiled)
+    return self.particles.result(), self.particles
 
 class MH(Handler):
   def __init__(self):
@@ -564,8 +1082,26 @@ class MH(Handler):
     return score + s
   
   def resample(self, particle: Particle) -> Particle:
-    # Resample is a no-op for MH
-    return particle.update(cont=Const(None), finished=True)
+    # Resample does not change the particle, but interrupts it to record a checkpoint
+    return particle.update(cont=Const(None), finished=False)
+
+  # Evaluates the particle to the end, recording at each resample point a copy of the
+  # particle and the scores of the sample sites drawn before it, to replay the program from.
+  # The variables the particle cannot reach are collected before it is copied, as by ProbState.collect
+  def run(
+    self,
+    particle: Particle,
+    program: CompiledProgram,
+    trace: List[Tuple[Particle, Dict[RandomVar, float]]],
+    gc_growth: Optional[float] = 2.,
+  ) -> Particle:
+    particle = self.evaluate_particle(particle, program)
+    while not particle.finished:
+      if gc_growth is not None and len(particle.state) > gc_growth * particle.state.live:
+        particle.state.clean(particle.roots())
+      trace.append((copy(particle), {**self.sample_scores}))
+      particle = self.evaluate_particle(particle, program)
+    return particle
   
   def mh(self, old_score, old_sample_scores, score, sample_scores) -> float:
     if np.isinf(score):
@@ -591,37 +1127,59 @@ class MH(Handler):
     seed: Optional[int] = None, 
     **kwargs: P.kwargs,
   ) -> Tuple[SymExpr, ProbState]:
-    functions, expression = program.functions, program.main
-
-    # Make lookup for functions
-    functions = {f.name: f for f in functions}
+    # Compile the program once, shared by all particles
+    compiled = CompiledProgram(program, file_dir)
+    expression = program.main
 
     n_samples = kwargs.get("n_samples", 1)
     n_warmups = kwargs.get("n_warmups", 1)
     n_thinning = kwargs.get("n_thinning", 1)
+    gc_growth = kwargs.get("gc_growth", 2.)
 
     particles = []
 
-    particle = Particle(expression, method(self.value(), seed=seed))
-    particle = self.evaluate_particle(particle, functions, file_dir)
+    # The chain draws its proposals from its own stream, and each run from a spawned stream
+    seed_seq = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seed_seq)
+
+    # Checkpoints of the current run at its resample points
+    trace: List[Tuple[Particle, Dict[RandomVar, float]]] = []
+    particle = Particle(expression, method(self.value(), seed=seed_seq.spawn(1)[0]))
+    particle = self.run(particle, compiled, trace, gc_growth)
+    # Each run reads the streams again
+    compiled.release_streams()
     # print(self.sample_sites)
 
     for i in range(n_warmups + n_samples * n_thinning):
       old_sample_sites = {k: deepcopy(v) if isinstance(v.v, List) else v for k, v in self.sample_sites.items()}
       old_sample_scores = {**self.sample_scores}
       old_particle = particle
+      old_trace = trace
       keys = [k for k in self.sample_sites.keys()]
       if len(keys) == 0:
         # Fully symbolic, so no need to do MH
         particles.append(particle)
         break
-      regen = np.random.choice(keys)
+      regen = keys[rng.integers(len(keys))]
       del self.sample_sites[regen]
-      # reset scores so we know which ones were used
-      self.sample_scores = {}
 
-      particle = Particle(expression, method(self.value(), seed=seed))
-      particle = self.evaluate_particle(particle, functions, file_dir)
+      # Only the part of the program from the last checkpoint before the regenerated
+      # site was drawn is evaluated again, the sites drawn before keep their scores
+      n_kept = 0
+      while n_kept < len(trace) and regen not in trace[n_kept][1]:
+        n_kept += 1
+      trace = trace[:n_kept]
+      if n_kept > 0:
+        checkpoint, checkpoint_scores = trace[-1]
+        particle = copy(checkpoint)
+        self.sample_scores = {**checkpoint_scores}
+      else:
+        particle = Particle(expression, method(self.value(), seed=seed_seq.spawn(1)[0]))
+        # reset scores so we know which ones were used
+        self.sample_scores = {}
+
+      particle = self.run(particle, compiled, trace, gc_growth)
+      compiled.release_streams()
 
       # delete samples sites that were not used
       for k in list(self.sample_sites.keys()):
@@ -640,11 +1198,12 @@ class MH(Handler):
 
       alpha = self.mh(old_particle.score, old_sample_scores, particle.score, self.sample_scores)
       # print("alpha:", alpha)
-      u = np.random.random()
+      u = rng.random()
       if not (u <= alpha):
         # print("u:", u)
         # Restore the old sample sites
         particle = old_particle
+        trace = old_trace
         self.sample_sites = old_sample_sites
         self.sample_scores = old_sample_scores
       # else:
@@ -1,6 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Tuple, TypeVar, Generic, List
+from typing import Tuple, TypeVar, Generic, List, Any, Dict, Iterable, Iterator, ClassVar
+from weakref import ref
 import numpy as np
 import math
 
@@ -35,15 +36,15 @@ Operator = Enum("Operator", [
   "poisson", "delta", "categorical", "uniform_int", "student_t", 
 ])
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Expr(Generic[S]):
   pass
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Op(Expr[S]):
   pass
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Identifier(Expr):
   module: str | None
   name: str | None
@@ -56,7 +57,7 @@ class Identifier(Expr):
   def __repr__(self) -> str:
     return str(self)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class GenericOp(Op[S]):
   op: Operator
   args: List['Expr[S]']
@@ -64,7 +65,7 @@ class GenericOp(Op[S]):
   def __str__(self):
     return f"{self.op.name}({self.args})"
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Fold(Expr[S]):
   func: Identifier
   init: 'Expr[S]'
@@ -73,7 +74,7 @@ class Fold(Expr[S]):
   def __str__(self):
     return f"fold({self.func}, {self.init}, {self.acc})"
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Apply(Expr[S]):
   func: Identifier
   args: List['Expr[S]']
@@ -81,7 +82,7 @@ class Apply(Expr[S]):
   def __str__(self):
     return f"{self.func}({self.args})"
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class IfElse(Expr[S]):
   cond: 'Expr[S]'
   then: 'Expr[S]'
@@ -90,7 +91,7 @@ class IfElse(Expr[S]):
   def __str__(self):
     return f"if {self.cond} then {self.then} else {self.else_}"
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Let(Expr[S]):
   var: List[Identifier]
   value: 'Expr[S]'
@@ -101,7 +102,7 @@ class Let(Expr[S]):
       return f"let () = {self.value} in {self.body}"
     return f"let {', '.join(map(str, self.var))} = {self.value} in {self.body}"
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class LetRV(Expr[S]):
   var: Identifier
   annotation: Annotation | None
@@ -113,7 +114,7 @@ class LetRV(Expr[S]):
       return f"let {self.var} <- {self.distribution} in {self.body}"
     return f"let {self.annotation} {self.var} <- {self.distribution} in {self.body}"
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Observe(Expr[S]):
   condition: 'Op[S]'
   observation: 'Expr[S]'
@@ -121,13 +122,13 @@ class Observe(Expr[S]):
   def __str__(self):
     return f"observe({self.condition}, {self.observation})"
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Resample(Expr):
 
   def __str__(self):
     return f"resample()"
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Function(Expr[S]):
   name: Identifier
   args: List[Identifier]
@@ -136,21 +137,128 @@ class Function(Expr[S]):
   def __str__(self):
     return f"val {self.name} = fun ({', '.join(map(str, self.args))}) = {self.body}"
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Program:
   functions: List[Function]
   main: Expr
+  # Purity of each expression, filled in by siren.utils.purity the first time it is needed
+  purity: Dict[int, bool] = field(default_factory=dict, init=False, compare=False, repr=False)
+
+  # Pickles without the purity, which is keyed by ids
+  def __reduce__(self) -> Tuple[Any, ...]:
+    return (Program, (self.functions, self.main))
 
   def __str__(self):
     funcs = '\n'.join(map(str, self.functions))
     return f"{funcs}\n{self.main}"
 
-@dataclass(frozen=True)
-class SymExpr(Generic[T], Expr['SymExpr']):
+# Symbolic expressions are hash-consed: structurally equal expressions are the same object,
+# so particles share identical subtrees, equal expressions compare by identity,
+# and hashes are computed once per expression
+
+# Key of a field in the hash-consing table. Subexpressions are already interned so are keyed 
+# by identity, and values are keyed with their type so that e.g. Const(1) and Const(1.0) are 
+# not merged. Lists and other unhashable values raise TypeError
+def _intern_key(v: Any) -> Any:
+  t = type(v)
+  if t.__class__ is Interned:
+    return id(v)
+  if t is list:
+    raise TypeError(v)
+  if t is tuple:
+    return (t, tuple(map(_intern_key, v)))
+  if isinstance(v, float) and v == 0:
+    # 0.0 and -0.0 are equal but not interchangeable
+    return (t, v, math.copysign(1., v))
+  return (t, v)
+
+# Equality is an identity check for equal expressions, otherwise compares the fields
+# like the dataclass equality (e.g. Const(1) == Const(1.0))
+def _interned_eq(self, other: Any) -> bool:
+  if self is other:
+    return True
+  if other.__class__ is not self.__class__:
+    return NotImplemented
+  return tuple(getattr(self, f) for f in self.__match_args__) ==\
+    tuple(getattr(other, f) for f in other.__match_args__)
+
+# Same hash as the dataclass hash, cached on the expression
+def _interned_hash(self) -> int:
+  try:
+    return self._hash
+  except AttributeError:
+    h = hash(tuple(getattr(self, f) for f in self.__match_args__))
+    object.__setattr__(self, '_hash', h)
+    return h
+
+# Removes the entry of a freed expression, unless it was already replaced by a new expression
+def _remove_dead(key: Any, r: 'ref[SymExpr]') -> None:
+  if Interned.table.get(key) is r:
+    del Interned.table[key]
+
+class Interned(type):
+  # All live symbolic expressions, as weak references so unused expressions are freed
+  table: Dict[Any, 'ref[SymExpr]'] = {}
+
+  def __new__(mcs, name, bases, namespace, **kwargs):
+    # Defined on each class so the dataclass decorator does not generate its own
+    namespace.setdefault('__eq__', _interned_eq)
+    namespace.setdefault('__hash__', _interned_hash)
+    return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+  def __call__(cls, *args, **kwargs):
+    expr = None
+    if len(kwargs) > 0 or len(args) != len(cls.__match_args__):
+      expr = type.__call__(cls, *args, **kwargs)
+      args = tuple(getattr(expr, f) for f in cls.__match_args__)
+
+    try:
+      key = (cls, *map(_intern_key, args))
+      r = Interned.table.get(key)
+    except TypeError:
+      # Expressions with unhashable values are not interned
+      return expr if expr is not None else type.__call__(cls, *args)
+    if r is not None:
+      interned = r()
+      if interned is not None:
+        return interned
+
+    if expr is None:
+      expr = type.__call__(cls, *args)
+    Interned.table[key] = ref(expr, lambda r: _remove_dead(key, r))
+    return expr
+
+# Random variables of an expression from those of its children, cached on the expression
+def _union_rvs(expr: 'SymExpr', *children: 'SymExpr') -> Tuple['RandomVar', ...]:
+  try:
+    return expr._rvs
+  except AttributeError:
+    rvs = tuple(dict.fromkeys(rv for e in children for rv in e.rvs()))
+    object.__setattr__(expr, '_rvs', rvs)
+    return rvs
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class SymExpr(Generic[T], Expr['SymExpr'], metaclass=Interned):
+  # Cached hash and random variables, set on first use
+  _hash: int = field(init=False, compare=False, repr=False)
+  _rvs: Tuple['RandomVar', ...] = field(init=False, compare=False, repr=False)
+
   def __str__(self):
     return "SymExpr"
+
+  # Expressions are immutable, so copies are the expression itself
+  # and unpickling interns them again
+  def __copy__(self) -> 'SymExpr':
+    return self
+
+  def __deepcopy__(self, memo: Any) -> 'SymExpr':
+    return self
+
+  def __reduce__(self) -> Tuple[Any, ...]:
+    return (type(self), tuple(getattr(self, f) for f in self.__match_args__))
   
-  def rvs(self) -> List['RandomVar']:
+  # Random variables in the expression, without duplicates and in order of occurrence
+  def rvs(self) -> Tuple['RandomVar', ...]:
     raise NotImplementedError()
   
   def depends_on(self, rv: 'RandomVar', transitive: bool = False) -> bool:
@@ -162,7 +270,7 @@ class SymExpr(Generic[T], Expr['SymExpr']):
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     raise NotImplementedError()
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Const(SymExpr[T]):
   v: T
 
@@ -179,8 +287,8 @@ class Const(SymExpr[T]):
       return f"({', '.join(map(str, self.v))})"
     return f"{self.v}"
   
-  def rvs(self) -> List['RandomVar']:
-    return []
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return ()
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return self
@@ -191,22 +299,22 @@ class Const(SymExpr[T]):
     else:
       raise TypeError(f"Cannot round {self.v}")
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class RandomVar(SymExpr[T]):
   rv: str
 
   def __str__(self):
     return f"RV({self.rv})"
   
-  def rvs(self) -> List['RandomVar']:
-    return [self]
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return (self,)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     if self == rv:
       return value
     return self
     
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Add(SymExpr[Number], Op[SymExpr]):
   left: 'SymExpr[Number]'
   right: 'SymExpr[Number]'
@@ -214,8 +322,8 @@ class Add(SymExpr[Number], Op[SymExpr]):
   def __str__(self):
     return f"({self.left} + {self.right})"
   
-  def rvs(self) -> List['RandomVar']:
-    return self.left.rvs() + self.right.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.left, self.right)
   
   @staticmethod
   def make(left: 'SymExpr[Number]', right: 'SymExpr[Number]') -> 'SymExpr[Number]':
@@ -232,7 +340,7 @@ class Add(SymExpr[Number], Op[SymExpr]):
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return Add(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Mul(SymExpr[Number], Op[SymExpr]):
   left: 'SymExpr[Number]'
   right: 'SymExpr[Number]'
@@ -240,8 +348,8 @@ class Mul(SymExpr[Number], Op[SymExpr]):
   def __str__(self):
     return f"({self.left} * {self.right})"
   
-  def rvs(self) -> List['RandomVar']:
-    return self.left.rvs() + self.right.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.left, self.right)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return Mul(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
@@ -260,7 +368,7 @@ class Mul(SymExpr[Number], Op[SymExpr]):
       case _:
         return Mul(left, right)
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Div(SymExpr[Number], Op[SymExpr]):
   left: 'SymExpr[Number]'
   right: 'SymExpr[Number]'
@@ -268,8 +376,8 @@ class Div(SymExpr[Number], Op[SymExpr]):
   def __str__(self):
     return f"({self.left} / {self.right})"
   
-  def rvs(self) -> List['RandomVar']:
-    return self.left.rvs() + self.right.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.left, self.right)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return Div(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
@@ -282,7 +390,7 @@ class Div(SymExpr[Number], Op[SymExpr]):
       case _:
         return Div(left, right)
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Ite(SymExpr[T], Op[SymExpr]):
   cond: 'SymExpr[bool]'
   true: 'SymExpr[T]'
@@ -291,8 +399,8 @@ class Ite(SymExpr[T], Op[SymExpr]):
   def __str__(self):
     return f"ite({self.cond}, {self.true}, {self.false})"
   
-  def rvs(self) -> List['RandomVar']:
-    return self.cond.rvs() + self.true.rvs() + self.false.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.cond, self.true, self.false)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return Ite(self.cond.subst_rv(rv, value), self.true.subst_rv(rv, value), self.false.subst_rv(rv, value))
@@ -305,7 +413,7 @@ class Ite(SymExpr[T], Op[SymExpr]):
       case _:
         return Ite(cond, true, false)
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Eq(SymExpr[bool], Op[SymExpr]):
   left: 'SymExpr'
   right: 'SymExpr'
@@ -313,8 +421,8 @@ class Eq(SymExpr[bool], Op[SymExpr]):
   def __str__(self):
     return f"({self.left} = {self.right})"
   
-  def rvs(self) -> List['RandomVar']:
-    return self.left.rvs() + self.right.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.left, self.right)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return Eq(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
@@ -327,7 +435,7 @@ class Eq(SymExpr[bool], Op[SymExpr]):
       case _:
         return Eq(left, right)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Lt(SymExpr[bool], Op[SymExpr]):
   left: 'SymExpr[Number]'
   right: 'SymExpr[Number]'
@@ -335,8 +443,8 @@ class Lt(SymExpr[bool], Op[SymExpr]):
   def __str__(self):
     return f"({self.left} < {self.right})"
   
-  def rvs(self) -> List['RandomVar']:
-    return self.left.rvs() + self.right.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.left, self.right)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return Lt(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
@@ -349,7 +457,7 @@ class Lt(SymExpr[bool], Op[SymExpr]):
       case _:
         return Lt(left, right)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Pair(SymExpr[T]):
   fst: 'SymExpr[T]'
   snd: 'SymExpr[T]'
@@ -357,27 +465,124 @@ class Pair(SymExpr[T]):
   def __str__(self):
     return f"({self.fst}, {self.snd})"
   
-  def rvs(self) -> List['RandomVar']:
-    return self.fst.rvs() + self.snd.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.fst, self.snd)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
     return Pair(self.fst.subst_rv(rv, value), self.snd.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+# Persistent list of symbolic expressions, made of interned cons cells. Consing, head and tail
+# are constant time, lists built from one another share their tails,
+# and lists of the same expressions are the same object
+@dataclass(frozen=True, slots=True, weakref_slot=True, repr=False)
+class PList(Generic[T], metaclass=Interned):
+  head: 'SymExpr[T] | None'
+  tail: 'PList[T] | None'
+  # Length, from that of the tail, and hash, cached on first use
+  _len: int = field(init=False, compare=False)
+  _hash: int = field(init=False, compare=False)
+
+  # The empty list, whose head and tail are None
+  empty: ClassVar['PList']
+
+  def __post_init__(self) -> None:
+    if self.tail is None:
+      object.__setattr__(self, '_len', 0)
+      object.__setattr__(self, '_hash', hash(()))
+    else:
+      object.__setattr__(self, '_len', self.tail._len + 1)
+
+  @staticmethod
+  def of(exprs: Iterable['SymExpr[T]']) -> 'PList[T]':
+    l = PList.empty
+    for e in reversed(list(exprs)):
+      l = PList(e, l)
+    return l
+
+  def cons(self, expr: 'SymExpr[T]') -> 'PList[T]':
+    return PList(expr, self)
+
+  def rev(self) -> 'PList[T]':
+    l = PList.empty
+    for e in self:
+      l = PList(e, l)
+    return l
+
+  def __len__(self) -> int:
+    return self._len
+
+  def __iter__(self) -> Iterator['SymExpr[T]']:
+    l = self
+    while l.tail is not None:
+      yield l.head
+      l = l.tail
+
+  def __getitem__(self, i: int) -> 'SymExpr[T]':
+    if i < 0:
+      i += self._len
+    if not 0 <= i < self._len:
+      raise IndexError(i)
+    l = self
+    for _ in range(i):
+      l = l.tail
+    return l.head
+
+  # Compares the cells iteratively, stopping at shared tails
+  def __eq__(self, other: Any) -> bool:
+    if other.__class__ is not PList:
+      return NotImplemented
+    l1, l2 = self, other
+    while l1 is not l2:
+      if l1._len != l2._len or l1.head != l2.head:
+        return False
+      l1, l2 = l1.tail, l2.tail
+    return True
+
+  # Hashes the cells not hashed yet from the last one, so long lists do not recurse
+  def __hash__(self) -> int:
+    cells = []
+    l = self
+    while True:
+      try:
+        h = l._hash
+        break
+      except AttributeError:
+        cells.append(l)
+        l = l.tail
+    for l in reversed(cells):
+      h = hash((l.head, h))
+      object.__setattr__(l, '_hash', h)
+    return h
+
+  def __copy__(self) -> 'PList[T]':
+    return self
+
+  def __deepcopy__(self, memo: Any) -> 'PList[T]':
+    return self
+
+  def __reduce__(self) -> Tuple[Any, ...]:
+    return (PList.of, (list(self),))
+
+  def __repr__(self) -> str:
+    return repr(list(self))
+
+PList.empty = PList(None, None)
+
+@dataclass(frozen=True, slots=True)
 class Lst(SymExpr[T]):
-  exprs: List['SymExpr[T]']
+  exprs: PList[T]
 
   def __str__(self):
     return f"[{', '.join(map(str, self.exprs))}]"
   
-  def rvs(self) -> List['RandomVar']:
-    return sum((e.rvs() for e in self.exprs), [])
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, *self.exprs)
   
   def subst_rv(self, rv: 'RandomVar', value: 'SymExpr') -> 'SymExpr':
-    return Lst([e.subst_rv(rv, value) for e in self.exprs])
+    return Lst(PList.of(e.subst_rv(rv, value) for e in self.exprs))
 
 # Symbolic distributions are a type of symbolic expression and are built-in operators
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class SymDistr(SymExpr[T], Op[SymExpr]):
   
   def draw(self, rng: np.random.Generator) -> T:
@@ -392,7 +597,7 @@ class SymDistr(SymExpr[T], Op[SymExpr]):
   def variance(self) -> float:
     raise NotImplementedError()
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Normal(SymDistr[float]):
   mu: 'SymExpr[float]'
   var: 'SymExpr[float]'
@@ -424,10 +629,10 @@ class Normal(SymDistr[float]):
     _, var = self.marginal_parameters()
     return var
   
-  def rvs(self) -> List['RandomVar']:
-    return self.mu.rvs() + self.var.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.mu, self.var)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Bernoulli(SymDistr[bool]):
   p: 'SymExpr[float]'
 
@@ -457,10 +662,10 @@ class Bernoulli(SymDistr[bool]):
     p = self.marginal_parameters()
     return p * (1 - p)
   
-  def rvs(self) -> List['RandomVar']:
-    return self.p.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.p)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Beta(SymDistr[float]):
   a: 'SymExpr[float]'
   b: 'SymExpr[float]'
@@ -495,10 +700,10 @@ class Beta(SymDistr[float]):
     a, b = self.marginal_parameters()
     return (a * b) / ((a + b) ** 2 * (a + b + 1))
   
-  def rvs(self) -> List['RandomVar']:
-    return self.a.rvs() + self.b.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.a, self.b)
     
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Binomial(SymDistr[int]):
   n: 'SymExpr[int]'
   p: 'SymExpr[float]'
@@ -533,10 +738,10 @@ class Binomial(SymDistr[int]):
     n, p = self.marginal_parameters()
     return n * p * (1 - p)
   
-  def rvs(self) -> List['RandomVar']:
-    return self.n.rvs() + self.p.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.n, self.p)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class BetaBinomial(SymDistr[int]):
   n : 'SymExpr[int]'
   a : 'SymExpr[float]'
@@ -574,10 +779,10 @@ class BetaBinomial(SymDistr[int]):
     n, a, b = self.marginal_parameters()
     return (n * a * b * (a + b + n)) / ((a + b) ** 2 * (a + b + 1))
   
-  def rvs(self) -> List['RandomVar']:
-    return self.n.rvs() + self.a.rvs() + self.b.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.n, self.a, self.b)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class NegativeBinomial(SymDistr[int]):
   n: 'SymExpr[int]'
   p: 'SymExpr[float]'
@@ -611,10 +816,10 @@ class NegativeBinomial(SymDistr[int]):
     n, p = self.marginal_parameters()
     return n * (1 - p) / (p ** 2)
   
-  def rvs(self) -> List['RandomVar']:
-    return self.n.rvs() + self.p.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.n, self.p)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Gamma(SymDistr[float]):
   a: 'SymExpr[float]'
   b: 'SymExpr[float]'
@@ -649,10 +854,10 @@ class Gamma(SymDistr[float]):
     a, b = self.marginal_parameters()
     return a / (b ** 2)
   
-  def rvs(self) -> List['RandomVar']:
-    return self.a.rvs() + self.b.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.a, self.b)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Poisson(SymDistr[int]):
   l: 'SymExpr[float]'
 
@@ -684,10 +889,10 @@ class Poisson(SymDistr[int]):
     l = self.marginal_parameters()
     return l
   
-  def rvs(self) -> List['RandomVar']:
-    return self.l.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.l)
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class StudentT(SymDistr[float]):
   mu: 'SymExpr[float]'
   tau2: 'SymExpr[float]'
@@ -724,10 +929,10 @@ class StudentT(SymDistr[float]):
       return tau2 * nu / (nu - 2)
     return np.inf
   
-  def rvs(self) -> List['RandomVar']:
-    return self.mu.rvs() + self.tau2.rvs() + self.nu.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.mu, self.tau2, self.nu)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Categorical(SymDistr[int]):
   lower: 'SymExpr[int]'
   upper: 'SymExpr[int]'
@@ -766,10 +971,10 @@ class Categorical(SymDistr[int]):
     lower, _, probs = self.marginal_parameters()
     return sum((i + lower) ** 2 * p for i, p in enumerate(probs)) - self.mean() ** 2
   
-  def rvs(self) -> List['RandomVar']:
-    return self.lower.rvs() + self.upper.rvs() + self.probs.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.lower, self.upper, self.probs)
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Delta(SymDistr[T]):
   v: 'SymExpr[T]'
   sampled: bool = False
@@ -801,13 +1006,13 @@ class Delta(SymDistr[T]):
   def variance(self) -> float:
     return 0
   
-  def rvs(self) -> List['RandomVar']:
-    return self.v.rvs()
+  def rvs(self) -> Tuple['RandomVar', ...]:
+    return _union_rvs(self, self.v)
 
 ### Abstract Symbolic expressions ###
 ### All hybrid inference engines should be able to handle these ###
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsSymExpr(Generic[T], Expr['AbsSymExpr']):
   def __str__(self):
     return "AbsSymExpr"
@@ -827,7 +1032,7 @@ class AbsSymExpr(Generic[T], Expr['AbsSymExpr']):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     raise NotImplementedError()
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class TopE(AbsSymExpr[T]):
   def __str__(self):
     return "TopE"
@@ -848,7 +1053,7 @@ class TopE(AbsSymExpr[T]):
   
 # UnkE represents an unknown expression that depends on a set of random variables
 # It's a refinement of TopE
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class UnkE(AbsSymExpr[T]):
   parents: List['AbsRandomVar']
 
@@ -882,7 +1087,7 @@ class UnkE(AbsSymExpr[T]):
     return UnkE(parents)
 
 # UnkC represents an unknown constant
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class UnkC:
   def __str__(self):
     return "UnkC"
@@ -914,7 +1119,7 @@ class UnkC:
   def __neg__(self):
     return UnkC()
     
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsConst(AbsSymExpr[T]):
   v: T | UnkC
 
@@ -940,7 +1145,7 @@ class AbsConst(AbsSymExpr[T]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return self
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsRandomVar(AbsSymExpr[T]):
   rv: str
 
@@ -960,7 +1165,7 @@ class AbsRandomVar(AbsSymExpr[T]):
       return value
     return self
     
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsAdd(AbsSymExpr[Number], Op[AbsSymExpr]):
   left: 'AbsSymExpr[Number]'
   right: 'AbsSymExpr[Number]'
@@ -977,7 +1182,7 @@ class AbsAdd(AbsSymExpr[Number], Op[AbsSymExpr]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsAdd(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsMul(AbsSymExpr[Number], Op[AbsSymExpr]):
   left: 'AbsSymExpr[Number]'
   right: 'AbsSymExpr[Number]'
@@ -994,7 +1199,7 @@ class AbsMul(AbsSymExpr[Number], Op[AbsSymExpr]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsMul(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsDiv(AbsSymExpr[Number], Op[AbsSymExpr]):
   left: 'AbsSymExpr[Number]'
   right: 'AbsSymExpr[Number]'
@@ -1011,7 +1216,7 @@ class AbsDiv(AbsSymExpr[Number], Op[AbsSymExpr]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsDiv(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsIte(AbsSymExpr[T], Op[AbsSymExpr]):
   cond: 'AbsSymExpr[bool]'
   true: 'AbsSymExpr[T]'
@@ -1029,7 +1234,7 @@ class AbsIte(AbsSymExpr[T], Op[AbsSymExpr]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsIte(self.cond.subst_rv(rv, value), self.true.subst_rv(rv, value), self.false.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsEq(AbsSymExpr[bool], Op[AbsSymExpr]):
   left: 'AbsSymExpr'
   right: 'AbsSymExpr'
@@ -1046,7 +1251,7 @@ class AbsEq(AbsSymExpr[bool], Op[AbsSymExpr]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsEq(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsLt(AbsSymExpr[bool], Op[AbsSymExpr]):
   left: 'AbsSymExpr[Number]'
   right: 'AbsSymExpr[Number]'
@@ -1063,7 +1268,7 @@ class AbsLt(AbsSymExpr[bool], Op[AbsSymExpr]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsLt(self.left.subst_rv(rv, value), self.right.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsPair(AbsSymExpr[T]):
   fst: 'AbsSymExpr[T]'
   snd: 'AbsSymExpr[T]'
@@ -1080,7 +1285,7 @@ class AbsPair(AbsSymExpr[T]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsPair(self.fst.subst_rv(rv, value), self.snd.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsLst(AbsSymExpr[T]):
   exprs: List['AbsSymExpr[T]']
 
@@ -1096,7 +1301,7 @@ class AbsLst(AbsSymExpr[T]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsSymExpr':
     return AbsLst([e.subst_rv(rv, value) for e in self.exprs])
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsSymDistr(AbsSymExpr[T], Op[AbsSymExpr]):
   def __str__(self):
     return "AbsSymDistr"
@@ -1108,7 +1313,7 @@ class AbsSymDistr(AbsSymExpr[T], Op[AbsSymExpr]):
     raise NotImplementedError()
   
 # Analogous to TopE
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class TopD(AbsSymDistr[T]):
   def __str__(self):
     return "TopD"
@@ -1123,7 +1328,7 @@ class TopD(AbsSymDistr[T]):
     return self
 
 # Analogous to UnkE
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class UnkD(AbsSymDistr[T]):
   parents: List[AbsRandomVar]
 
@@ -1154,7 +1359,7 @@ class UnkD(AbsSymDistr[T]):
     parents.extend(new_parents)
     return UnkD(parents)
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsNormal(AbsSymDistr[float]):
   mu: 'AbsSymExpr[float]'
   var: 'AbsSymExpr[float]'
@@ -1171,7 +1376,7 @@ class AbsNormal(AbsSymDistr[float]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsNormal':
     return AbsNormal(self.mu.subst_rv(rv, value), self.var.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsBernoulli(AbsSymDistr[bool]):
   p: 'AbsSymExpr[float]'
 
@@ -1187,7 +1392,7 @@ class AbsBernoulli(AbsSymDistr[bool]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsBernoulli':
     return AbsBernoulli(self.p.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsBeta(AbsSymDistr[float]):
   a: 'AbsSymExpr[float]'
   b: 'AbsSymExpr[float]'
@@ -1204,7 +1409,7 @@ class AbsBeta(AbsSymDistr[float]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsBeta':
     return AbsBeta(self.a.subst_rv(rv, value), self.b.subst_rv(rv, value))
     
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsBinomial(AbsSymDistr[int]):
   n: 'AbsSymExpr[int]'
   p: 'AbsSymExpr[float]'
@@ -1221,7 +1426,7 @@ class AbsBinomial(AbsSymDistr[int]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsBinomial':
     return AbsBinomial(self.n.subst_rv(rv, value), self.p.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsBetaBinomial(AbsSymDistr[int]):
   n: 'AbsSymExpr[int]'
   a: 'AbsSymExpr[float]'
@@ -1239,7 +1444,7 @@ class AbsBetaBinomial(AbsSymDistr[int]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsBetaBinomial':
     return AbsBetaBinomial(self.n.subst_rv(rv, value), self.a.subst_rv(rv, value), self.b.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsNegativeBinomial(AbsSymDistr[int]):
   k: 'AbsSymExpr[int]'
   p: 'AbsSymExpr[float]'
@@ -1256,7 +1461,7 @@ class AbsNegativeBinomial(AbsSymDistr[int]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsNegativeBinomial':
     return AbsNegativeBinomial(self.k.subst_rv(rv, value), self.p.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsGamma(AbsSymDistr[float]):
   a: 'AbsSymExpr[float]'
   b: 'AbsSymExpr[float]'
@@ -1273,7 +1478,7 @@ class AbsGamma(AbsSymDistr[float]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsGamma':
     return AbsGamma(self.a.subst_rv(rv, value), self.b.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsPoisson(AbsSymDistr[int]):
   l: 'AbsSymExpr[float]'
 
@@ -1289,7 +1494,7 @@ class AbsPoisson(AbsSymDistr[int]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsPoisson':
     return AbsPoisson(self.l.subst_rv(rv, value))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsStudentT(AbsSymDistr[float]):
   mu: 'AbsSymExpr[float]'
   tau2: 'AbsSymExpr[float]'
@@ -1307,7 +1512,7 @@ class AbsStudentT(AbsSymDistr[float]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsStudentT':
     return AbsStudentT(self.mu.subst_rv(rv, value), self.tau2.subst_rv(rv, value), self.nu.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsCategorical(AbsSymDistr[int]):
   lower: 'AbsSymExpr[int]'
   upper: 'AbsSymExpr[int]'
@@ -1325,7 +1530,7 @@ class AbsCategorical(AbsSymDistr[int]):
   def subst_rv(self, rv: 'AbsRandomVar', value: 'AbsSymExpr') -> 'AbsCategorical':
     return AbsCategorical(self.lower.subst_rv(rv, value), self.upper.subst_rv(rv, value), self.probs.subst_rv(rv, value))
   
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class AbsDelta(AbsSymDistr[T]):
   v: 'AbsSymExpr[T]'
   sampled: bool = False
@@ -51,6 +51,19 @@ class BPState(SymState):
   def set_node(self, rv: RandomVar, node: BPNode) -> None:
     self.set_entry(rv, node=node)
 
+  # Also keep the parent
+  def entry_referenced_rvs(self, rvs: Set[RandomVar]) -> Set[RandomVar]:
+    ref_rvs = super().entry_referenced_rvs(rvs)
+
+    for rv in rvs:
+      match self.node(rv):
+        case BPInitialized(rv_par):
+          ref_rvs.add(rv_par)
+        case _:
+          pass
+
+    return ref_rvs
+
   def assume(self, rv: RandomVar, name: Optional[Identifier], annotation: Optional[Annotation], distribution: SymDistr[T]) -> RandomVar[T]:
     def _check_conjugacy(prior : SymDistr, likelihood : SymDistr, rv_par : RandomVar, rv_child : RandomVar) -> bool:
       match prior, likelihood:
@@ -74,11 +87,8 @@ class BPState(SymState):
       # Otherwise, can only keep one parent and it has to be conjugate
       # Greedily choose the first conjugate parent
 
-      # Remove duplicate parents, in place
-      parents = []
-      for rv_par in distribution.rvs():
-        if rv_par not in parents:
-          parents.append(rv_par)
+      # Parents are already without duplicates
+      parents = distribution.rvs()
 
       # keep if conjugate, else sample it
       canonical_parent = None
@@ -179,10 +189,10 @@ class BPState(SymState):
   ########################################################################
 
   def score(self, rv: RandomVar[T], v: T) -> float:
-    return self.distr(rv).score(v)
+    return self.score_distr(self.distr(rv), v)
 
   def draw(self, rv: RandomVar) -> Any:
-    return self.distr(rv).draw(self.rng)
+    return self.draw_distr(self.distr(rv))
 
   def intervene(self, rv: RandomVar[T], v: Delta[T]) -> None:
     self.set_node(rv, BPRealized())
@@ -59,6 +59,45 @@ class DSState(SymState):
   def set_node(self, rv: RandomVar, node: DSNode) -> None:
     self.set_entry(rv, node=node)
 
+  # An initialized node needs its parent to be marginalized. A marginalized node only
+  # updates its parent when realized, which is not needed if the parent is not reachable.
+  # The marginal child of a reachable node may hold evidence the node has not been
+  # conditioned on yet, so it is kept, while its other children are not followed
+  def entry_referenced_rvs(self, rvs: Set[RandomVar]) -> Set[RandomVar]:
+    ref_rvs = super().entry_referenced_rvs(rvs)
+
+    for rv in rvs:
+      match self.node(rv):
+        case DSInitialized((rv_par, cdistr)):
+          ref_rvs.add(rv_par)
+          ref_rvs.update(cdistr.rvs())
+        case DSMarginalized(_):
+          rv_child = self.marginal_child(rv)
+          if rv_child is not None:
+            ref_rvs.add(rv_child)
+        case _:
+          pass
+
+    return ref_rvs
+
+  # Drops the edges to collected parents and children. A node is a child of its parent
+  # exactly when it has an edge to it, so only the neighbors of the collected nodes are visited
+  def forget(self, rvs: Set[RandomVar]) -> None:
+    for rv in rvs:
+      match self.node(rv):
+        case DSInitialized((rv_par, _)) | DSMarginalized((rv_par, _)) if rv_par not in rvs:
+          self.set_children(rv_par, [rv_child for rv_child in self.children(rv_par) if rv_child != rv])
+        case _:
+          pass
+
+      for rv_child in self.children(rv):
+        if rv_child not in rvs:
+          match self.node(rv_child):
+            case DSMarginalized((rv_par, _)) if rv_par == rv:
+              self.set_node(rv_child, DSMarginalized(None))
+            case _:
+              pass
+
   def assume(self, rv: RandomVar, name: Optional[Identifier], annotation: Optional[Annotation], distribution: SymDistr[T]) -> RandomVar[T]:
     def _check_conjugacy(prior : SymDistr, likelihood : SymDistr, rv_par : RandomVar, rv_child : RandomVar) -> bool:
       match prior, likelihood:
@@ -94,11 +133,8 @@ class DSState(SymState):
       # Otherwise, can only keep one parent and it has to be conjugate
       # Greedily choose the first conjugate parent
 
-      # Remove duplicate parents, in place
-      parents = []
-      for rv_par in distribution.rvs():
-        if rv_par not in parents:
-          parents.append(rv_par)
+      # Parents are already without duplicates
+      parents = distribution.rvs()
 
       # keep if conjugate, else sample it
       canonical_parent = None
@@ -119,7 +155,7 @@ class DSState(SymState):
               parent_dist = self.distr(rv_par)
               if _check_conjugacy(parent_dist, distribution, rv_par, rv):
                 if rv not in self.children(rv_par):
-                  self.children(rv_par).append(rv)
+                  self.set_children(rv_par, self.children(rv_par) + [rv])
 
                 canonical_parent = rv_par
                 has_parent = True
@@ -130,7 +166,7 @@ class DSState(SymState):
               # using the conditional distribution expression of the node
               if _check_conjugacy(parent_dist, distribution, rv_par, rv):
                 if rv not in self.children(rv_par):
-                  self.children(rv_par).append(rv)
+                  self.set_children(rv_par, self.children(rv_par) + [rv])
 
                 canonical_parent = rv_par
                 has_parent = True
@@ -185,17 +221,19 @@ class DSState(SymState):
         if len(self.children(rv)) > 0:
           self.graft(rv)
       case DSInitialized((rv_par, _)):
-        match self.node(rv_par):
-          case DSInitialized(_):
-            # recursively marginalize parent
-            self.marginalize(rv_par)
-            assert not isinstance(self.node(rv_par), DSInitialized)
-        # Turn RV into DSMarginalized
-        self.do_marginalize(rv)
-            
-        # Turn rv into terminal node if it has children
-        if len(self.children(rv)) > 0:
-          self.graft(rv)
+        # marginalize the initialized ancestors first, from the oldest one
+        path = [rv]
+        while isinstance(self.node(rv_par), DSInitialized):
+          path.append(rv_par)
+          rv_par = self.node(rv_par).edge[0]
+
+        for rv in reversed(path):
+          # Turn RV into DSMarginalized
+          self.do_marginalize(rv)
+
+          # Turn rv into terminal node if it has children
+          if len(self.children(rv)) > 0:
+            self.graft(rv)
       case _:
         raise ValueError(f'{rv} is {self.node(rv)}')
     
@@ -245,10 +283,10 @@ class DSState(SymState):
         raise ValueError(f'{rv} is {self.node(rv)}')
     
   def score(self, rv: RandomVar[T], v: T) -> float:
-    return self.distr(rv).score(v)
+    return self.score_distr(self.distr(rv), v)
 
   def draw(self, rv: RandomVar) -> Any:
-    return self.distr(rv).draw(self.rng)
+    return self.draw_distr(self.distr(rv))
 
   # Invariant 2: A node always has at most one child that is marginalized
   def marginal_child(self, rv: RandomVar) -> Optional[RandomVar]:
@@ -345,7 +383,9 @@ class DSState(SymState):
           case DSMarginalized(edge):
             if self.make_conditional(rv_par, rv, x.v):
               self.set_node(rv_par, DSMarginalized(edge))
-              self.children(rv_par).remove(rv)
+              children = list(self.children(rv_par))
+              children.remove(rv)
+              self.set_children(rv_par, children)
             else:
               raise ValueError(f'Cannot realize {rv} because {rv_par} is not conjugate')
           case _:
@@ -368,30 +408,41 @@ class DSState(SymState):
     
   # Makes RV a terminal node
   def graft(self, rv: RandomVar) -> None:
-    match self.node(rv):
-      case DSRealized():
-        raise ValueError(f'Cannot graft {rv} because it is already realized')
-      case DSMarginalized(_):
-        # Terminal nodes do not have marginal children
-        rv_child = self.marginal_child(rv)
-        if rv_child is not None:
-          self.prune(rv_child)
-      case DSInitialized((rv_par, _)):
-        # Recurse on parent, then try to marginalize rv
-        self.graft(rv_par)
-        self.do_marginalize(rv)
-      case _:
-        raise ValueError(f'{rv} is {self.node(rv)}')
+    # Walks up to the first ancestor that is not initialized, as the chain can be long
+    path = []
+    while True:
+      match self.node(rv):
+        case DSRealized():
+          raise ValueError(f'Cannot graft {rv} because it is already realized')
+        case DSMarginalized(_):
+          # Terminal nodes do not have marginal children
+          rv_child = self.marginal_child(rv)
+          if rv_child is not None:
+            self.prune(rv_child)
+          break
+        case DSInitialized((rv_par, _)):
+          # Graft the parent, then try to marginalize rv
+          path.append(rv)
+          rv = rv_par
+        case _:
+          raise ValueError(f'{rv} is {self.node(rv)}')
+
+    for rv in reversed(path):
+      self.do_marginalize(rv)
 
   # Samples the RV to remove the edge to its parent
   def prune(self, rv: RandomVar) -> None:
     match self.node(rv):
       case DSMarginalized(_):
-        # Recurse on children before sampling
-        rv_child = self.marginal_child(rv)
-        if rv_child is not None:
-          self.prune(rv_child)
-        
-        self.value(rv)
+        pass
       case _:
-        raise ValueError(f'{rv} is {self.node(rv)}')
\ No newline at end of file
+        raise ValueError(f'{rv} is {self.node(rv)}')
+
+    # Samples the chain of marginal children from the last one, before sampling rv
+    path = [rv]
+    rv_child = self.marginal_child(rv)
+    while rv_child is not None:
+      path.append(rv_child)
+      rv_child = self.marginal_child(rv_child)
+    for rv in reversed(path):
+      self.value(rv)
\ No newline at end of file
@@ -1,9 +1,9 @@
-from typing import Dict, Tuple, Optional, Set, Any, Callable, List
+from typing import Dict, Tuple, Optional, Set, Any, Callable, List, Iterator, Iterable
 from copy import copy, deepcopy
 import warnings
 
 from siren.grammar import *
-from siren.utils import is_pair, is_lst, get_pair, get_lst, fast_copy
+from siren.utils import is_pair, is_lst, get_pair, get_lst
 
 # Shared code between different inference algorithms
 # Contains the SymState interface algorithms must subclass and implement
@@ -12,29 +12,187 @@ from siren.utils import is_pair, is_lst, get_pair, get_lst, fast_copy
 class RuntimeViolatedAnnotationError(Exception):
   pass
 
+# Persistent hash map, used for the entries of the states so that a copy shares them
+# and an update copies only the path to its key. It is a hash array mapped trie: a node
+# is a list of 32 slots indexed by 5 bits of the hash, holding a subtrie, a leaf
+# (hash, key, value) or a bucket of keys with equal hashes. Nodes are never updated in place
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_MISSING = object()
+
+class _Bucket(object):
+  __slots__ = ('hash', 'entries')
+
+  def __init__(self, h: int, entries: Dict[Any, Any]) -> None:
+    self.hash = h
+    self.entries = entries
+
+def _pmap_set(node: Any, h: int, key: Any, value: Any, shift: int) -> Tuple[Any, int]:
+  if node is None:
+    return (h, key, value), 1
+  if type(node) is list:
+    i = (h >> shift) & _MASK
+    child, added = _pmap_set(node[i], h, key, value, shift + _BITS)
+    node = node.copy()
+    node[i] = child
+    return node, added
+  if type(node) is tuple:
+    if node[0] == h:
+      if node[1] is key or node[1] == key:
+        return (h, key, value), 0
+      return _Bucket(h, {node[1]: node[2], key: value}), 1
+    node_h = node[0]
+  else:
+    if node.hash == h:
+      return _Bucket(h, {**node.entries, key: value}), int(key not in node.entries)
+    node_h = node.hash
+  # Different hashes, so they differ in some later bits
+  branch: List[Any] = [None] * (1 << _BITS)
+  branch[(node_h >> shift) & _MASK] = node
+  return _pmap_set(branch, h, key, value, shift)
+
+def _pmap_delete(node: Any, h: int, key: Any, shift: int) -> Tuple[Any, bool]:
+  if node is None:
+    return None, False
+  if type(node) is list:
+    i = (h >> shift) & _MASK
+    child, removed = _pmap_delete(node[i], h, key, shift + _BITS)
+    if not removed:
+      return node, False
+    node = node.copy()
+    node[i] = child
+    # A branch left with a single leaf or bucket is replaced by it
+    children = [c for c in node if c is not None]
+    if len(children) == 0:
+      return None, True
+    if len(children) == 1 and type(children[0]) is not list:
+      return children[0], True
+    return node, True
+  if type(node) is tuple:
+    if node[0] == h and (node[1] is key or node[1] == key):
+      return None, True
+    return node, False
+  if node.hash != h or key not in node.entries:
+    return node, False
+  entries = {k: v for k, v in node.entries.items() if k != key}
+  if len(entries) == 1:
+    (k, v), = entries.items()
+    return (h, k, v), True
+  return _Bucket(h, entries), True
+
+class PMap(object):
+  __slots__ = ('root', 'size')
+
+  def __init__(self, root: Any = None, size: int = 0) -> None:
+    self.root = root
+    self.size = size
+
+  @staticmethod
+  def of(items: Iterable[Tuple[Any, Any]]) -> 'PMap':
+    m = PMap()
+    for k, v in items:
+      m = m.set(k, v)
+    return m
+
+  def get(self, key: Any, default: Any = None) -> Any:
+    h = hash(key)
+    node = self.root
+    shift = 0
+    while type(node) is list:
+      node = node[(h >> shift) & _MASK]
+      shift += _BITS
+    if node is None:
+      return default
+    if type(node) is tuple:
+      return node[2] if node[0] == h and (node[1] is key or node[1] == key) else default
+    return node.entries.get(key, default) if node.hash == h else default
+
+  def set(self, key: Any, value: Any) -> 'PMap':
+    root, added = _pmap_set(self.root, hash(key), key, value, 0)
+    return PMap(root, self.size + added)
+
+  def delete(self, key: Any) -> 'PMap':
+    root, removed = _pmap_delete(self.root, hash(key), key, 0)
+    return PMap(root, self.size - 1) if removed else self
+
+  def items(self) -> Iterator[Tuple[Any, Any]]:
+    todo = [self.root]
+    while len(todo) > 0:
+      node = todo.pop()
+      if node is None:
+        continue
+      if type(node) is list:
+        todo.extend(reversed(node))
+      elif type(node) is tuple:
+        yield node[1], node[2]
+      else:
+        yield from node.entries.items()
+
+  def keys(self) -> Iterator[Any]:
+    return (k for k, _ in self.items())
+
+  def values(self) -> Iterator[Any]:
+    return (v for _, v in self.items())
+
+  def __contains__(self, key: Any) -> bool:
+    return self.get(key, _MISSING) is not _MISSING
+
+  def __getitem__(self, key: Any) -> Any:
+    value = self.get(key, _MISSING)
+    if value is _MISSING:
+      raise KeyError(key)
+    return value
+
+  def __len__(self) -> int:
+    return self.size
+
+  def __iter__(self) -> Iterator[Any]:
+    return self.keys()
+
 # Symbolic state used for the hybrid inference interface
 class SymState(object):
   def __init__(self, value_f, seed=None) -> None:
     super().__init__()
     # State has to have distribution and pv
-    # State entries are maintained as a dictionary
-    self.state: Dict[RandomVar, Dict[str, Any]] = {}
+    # State entries are maintained as a persistent map, shared with the copies of the
+    # state. Entries are copied the first time they are updated after a copy
+    self.state: PMap = PMap()
+    self.owned: Set[RandomVar] = set()
     self.ctx: Context = Context()
     self.counter: int = 0
-    self.rng = np.random.default_rng(seed=seed)
+    # Number of values drawn, to tell whether evaluation was deterministic
+    self.draws: int = 0
+    # Program variables of the variables of the state, including the collected ones, and
+    # whether one of them was sampled. It is replaced instead of updated, so copies share it
+    self.encodings: Dict[Identifier, bool] = {}
+    # Number of variables left by the last collection
+    self.live: int = 0
+    # Random stream of the state, copies draw from streams spawned from it
+    self.seed_seq: np.random.SeedSequence = \
+      seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    self.rng = np.random.default_rng(self.seed_seq)
     # wrapper for the value function implemented by handler
     self.value_f: Callable[[SymState], Callable[[RandomVar], Const]] = value_f
     self.value: Callable[[RandomVar], Const] = value_f(self)
 
-  # Needs to be overridden if the state contains mutable objects
+  # Copying is constant time, as the state is copied on write.
+  # Needs to be overridden if the state contains other mutable objects
   def __copy__(self):
-    new_state = type(self)(self.value_f)
-    new_state.state = fast_copy(self.state)
+    new_state = type(self)(self.value_f, seed=self.seed_seq.spawn(1)[0])
+    new_state.state = self.state
+    self.owned = set()
     new_state.ctx = copy(self.ctx)
     new_state.counter = self.counter
-    new_state.rng = self.rng
+    new_state.draws = self.draws
+    new_state.encodings = self.encodings
+    new_state.live = self.live
     return new_state
 
+  # Draws from the given stream from now on
+  def reseed(self, seed: np.random.SeedSequence) -> None:
+    self.seed_seq = seed
+    self.rng = np.random.default_rng(seed)
+
   def new_var(self) -> RandomVar:
     self.counter += 1
     return RandomVar(f"rv{self.counter}")
@@ -44,20 +202,33 @@ class SymState(object):
   
   # Use this to get the value of a variable, which handles checking if the variable is in the state
   def get_entry(self, rv: RandomVar, key: str) -> Any:
-    if rv not in self.state:
+    entry = self.state.get(rv)
+    if entry is None:
       raise ValueError(f"{rv} not in state")
-    if key not in self.state[rv]:
+    if key not in entry:
       raise ValueError(f"{key} not in {rv}")
-    return self.state[rv][key]
-  
+    return entry[key]
+
   # Use this to set the value of a variable, which handles checking if the variable is in the state and if the annotation is violated
   # By trying to update a symbolic variable with a sampled distribution
   def set_entry(self, variable: RandomVar, **kwargs) -> None:
-    if variable not in self.state:
-      self.state[variable] = {}
+    if variable not in self.owned:
+      entry = self.state.get(variable)
+      entry = kwargs if entry is None else {**entry, **kwargs}
+      self.state = self.state.set(variable, entry)
+      self.owned.add(variable)
+    else:
+      entry = self.state[variable]
+      entry.update(kwargs)
 
-    for key, value in kwargs.items():
-      self.state[variable][key] = value
+    # Variables are never unsampled, so the encoding only changes the first time
+    # a variable of the program variable is seen or sampled
+    pv = entry.get('pv')
+    if pv is not None:
+      distribution = entry.get('distribution')
+      sampled = isinstance(distribution, Delta) and distribution.sampled
+      if pv not in self.encodings or (sampled and not self.encodings[pv]):
+        self.encodings = {**self.encodings, pv: sampled}
 
     # Check if annotations violated
     if 'distribution' in kwargs:
@@ -103,22 +274,33 @@ class SymState(object):
   def __str__(self):
     return f"SymState({', '.join(map(str, self.state.items()))})"
   
-  # Removes unreachable variables from the state
-  def clean(self) -> None:
-    used_vars = set().union(*(expr.rvs() for expr in self.ctx.context.values()))
-    # get referenced vars in the distribution of each ctx variable
-    while True:
-      new_used_vars = used_vars | set().union(*(self.distr(rv).rvs() for rv in used_vars))
-      if new_used_vars == used_vars:
-        used_vars = new_used_vars
-        break
-      else:
-        used_vars = new_used_vars
+  # Variables the entries of the given variables refer to, which are reachable if they are
+  def entry_referenced_rvs(self, rvs: Set[RandomVar]) -> Set[RandomVar]:
+    return set().union(*(self.distr(rv).rvs() for rv in rvs))
+
+  # Removes the references of the entries to collected variables, which are still in the state
+  def forget(self, rvs: Set[RandomVar]) -> None:
+    pass
+
+  # Removes the variables not reachable from the given ones (from the context by default)
+  def clean(self, roots: Optional[Set[RandomVar]] = None) -> None:
+    if roots is None:
+      roots = set().union(*(expr.rvs() for expr in self.ctx.context.values()))
+    # get referenced vars in the entries of the used vars, expanding only the new ones
+    used_vars = set(roots)
+    new_vars = used_vars
+    while len(new_vars) > 0:
+      new_vars = self.entry_referenced_rvs(new_vars) - used_vars
+      used_vars |= new_vars
 
-    # remove unused variables
-    for rv in self.vars():
-      if rv not in used_vars:
-        del self.state[rv]
+    # remove unused variables, their encodings are kept in the encodings of the state
+    unused_vars = [rv for rv in self.state if rv not in used_vars]
+    if len(unused_vars) > 0:
+      self.forget(set(unused_vars))
+      for rv in unused_vars:
+        self.state = self.state.delete(rv)
+        self.owned.discard(rv)
+    self.live = len(self.state)
 
   def str_distrs(self, rv: RandomVar) -> str:
     distr = self.eval(rv)
@@ -277,7 +459,7 @@ class SymState(object):
         case Lst(es):
           es = [self.eval(e) for e in es]
           const_list = _const_list(es)
-          return const_list if const_list is not None else Lst(es)
+          return const_list if const_list is not None else Lst(PList.of(es))
         case Pair(e1, e2):
           e1, e2 = self.eval(e1), self.eval(e2)
           match e1, e2:
@@ -346,6 +528,55 @@ class SymState(object):
         # print(type(expr))
         raise ValueError(expr)
 
+  # Computes the expectations of several expressions at once. The random variables they
+  # refer to are marginalized in a single pass over the state, ancestors first, so each one
+  # is marginalized right after its ancestors instead of marginalizing them again
+  def means(self, exprs: List[SymExpr]) -> List[Any]:
+    rvs = [expr for expr in exprs if isinstance(expr, RandomVar)]
+    targets = set(rvs)
+    rv_means = {rv: self.mean(rv) for rv in self.topological_order(rvs) if rv in targets}
+
+    def _mean(expr: SymExpr) -> Any:
+      match expr:
+        case Const(value):
+          return value
+        case RandomVar(_):
+          return rv_means[expr]
+        case _:
+          return self.mean(expr)
+
+    return [_mean(expr) for expr in exprs]
+
+  # The given random variables and their ancestors, with each one after its parents
+  def topological_order(self, rvs: List[RandomVar]) -> List[RandomVar]:
+    order = []
+    visited = set()
+    for root in rvs:
+      if root in visited:
+        continue
+      visited.add(root)
+      # Depth first search, without recursing on long chains of random variables
+      stack = [(root, iter(self.distr(root).rvs()))]
+      while len(stack) > 0:
+        rv, parents = stack[-1]
+        for rv_par in parents:
+          if rv_par not in visited:
+            visited.add(rv_par)
+            stack.append((rv_par, iter(self.distr(rv_par).rvs())))
+            break
+        else:
+          stack.pop()
+          order.append(rv)
+    return order
+
+  # Scores a value and draws from a distribution whose parameters are constants
+  def score_distr(self, distribution: SymDistr[T], v: T) -> float:
+    return distribution.score(v)
+
+  def draw_distr(self, distribution: SymDistr[T]) -> T:
+    self.draws += 1
+    return distribution.draw(self.rng)
+
   # Needs to be overridden by the implementation
   def marginalize(self, expr: RandomVar) -> None:
     raise NotImplementedError()
@@ -431,21 +662,33 @@ class Context(object):
     self.temp_counter += 1
     return Identifier(None, f"{name}_{self.temp_counter}")
 
+# Stack of frames to continue the evaluation from, each frame being a program counter
+# of the compiled program, the context to resume in, and the data to resume with.
+# It is a linked list that is never mutated, so copies of a particle share it
+Stack = Optional[Tuple[int, Context, Any, 'Stack']]
+
 # Particle object used for the hybrid inference
 # Maintains a symbolic state and an expression to simplfy
 # It also has a score, and a flag to indicate if it is finished
+# A particle can stand for several identical particles, given by its count
 class Particle(object):
   def __init__(
     self, cont: Expr[SymExpr], 
     state: SymState,
     score: float = 0.,
     finished: bool = False,
+    stack: Stack = None,
+    count: int = 1,
   ) -> None:
     super().__init__()
     self.cont: Expr[SymExpr] = cont
     self.state: SymState = state
     self.score: float = score  # logscale
     self.finished: bool = finished
+    self.stack: Stack = stack
+    self.count: int = count
+    # Whether the particle is interrupted waiting for a row to be fed, instead of by resample
+    self.waiting: bool = False
 
   # Asserts that the particle is finished and returns the final expression
   # which must be a symbolic expression
@@ -481,8 +724,33 @@ class Particle(object):
       copy(self.state),
       self.score,
       self.finished,
+      self.stack,
+      self.count,
     )
   
+  # Random variables the particle can still refer to, from its continuation, its context,
+  # and the contexts and values kept by the frames of its stack
+  def roots(self) -> Set[RandomVar]:
+    rvs = set()
+    todo: List[Any] = [self.cont, self.state.ctx]
+    frame = self.stack
+    while frame is not None:
+      _, ctx, data, frame = frame
+      todo.extend((ctx, data))
+    while len(todo) > 0:
+      match todo.pop():
+        case SymExpr() as expr:
+          rvs.update(expr.rvs())
+        case PList() as exprs:
+          rvs.update(Lst(exprs).rvs())
+        case Context() as ctx:
+          todo.extend(ctx.context.values())
+        case tuple() | list() as values:
+          todo.extend(values)
+        case _:
+          pass
+    return rvs
+
   # Only for debugging
   def simplify(self) -> 'Particle':
     for rv in self.state.vars():
@@ -542,7 +810,7 @@ class Mixture(object):
   def get_lst_mixture(self) -> List['Mixture']:
     if len(self.mixture) == 0:
       raise ValueError("No results")
-    all_lsts = [(get_lst(expr), s, w) for expr, s, w in self.mixture]
+    all_lsts = [(list(get_lst(expr)), s, w) for expr, s, w in self.mixture]
     max_len = max(len(lst) for lst, _, _ in all_lsts)
     acc = []
     for i in range(max_len):
@@ -559,21 +827,70 @@ class Mixture(object):
     if len(self.mixture) == 1:
       expr, state, _ = self.mixture[0]
       return state.mean(expr)
-    
-    unique_values = {}
-    for expr, state, weight in self.mixture:
-      v = state.mean(expr)
-      key = str(v)
-      
-      if key not in unique_values:
-        unique_values[key] = (v, weight)
-      else:
-        unique_values[key] = (v, unique_values[key][1] + weight)
-    
-    acc = 0.0
-    for v, weight in unique_values.values():
-      acc += weight * v
-    return acc
+
+    means = np.array([state.mean(expr) for expr, state, _ in self.mixture])
+    weights = np.array([weight for _, _, weight in self.mixture])
+    return np.dot(weights, means)
+
+# Splits a result into its structure of pairs and lists, with None in place of the values,
+# and the list of its values
+def _split_result(expr: SymExpr, values: List[SymExpr]) -> Any:
+  match expr:
+    case Pair(_, _) | Const(tuple()):
+      fst, snd = get_pair(expr)
+      return (_split_result(fst, values), _split_result(snd, values))
+    case Lst(_) | Const(list()):
+      return [_split_result(e, values) for e in get_lst(expr)]
+    case _:
+      values.append(expr)
+      return None
+
+# Rebuilds a result from its structure and its values
+def _join_result(structure: Any, values: Iterator[Any]) -> Any:
+  match structure:
+    case list():
+      return [_join_result(s, values) for s in structure]
+    case (fst, snd):
+      return (_join_result(fst, values), _join_result(snd, values))
+    case _:
+      return next(values)
+
+# Resampling schemes, drawing the indices of the n particles to keep from their probabilities
+def multinomial_resampling(rng: np.random.Generator, probabilities: np.ndarray, n: int) -> np.ndarray:
+  return rng.choice(np.arange(len(probabilities)), size=n, replace=True, p=probabilities)
+
+# One uniform draw shared by the n evenly spaced strata
+def systematic_resampling(rng: np.random.Generator, probabilities: np.ndarray, n: int) -> np.ndarray:
+  u = (rng.random() + np.arange(n)) / n
+  return np.minimum(np.searchsorted(np.cumsum(probabilities), u), len(probabilities) - 1)
+
+# One uniform draw in each of the n strata
+def stratified_resampling(rng: np.random.Generator, probabilities: np.ndarray, n: int) -> np.ndarray:
+  u = (rng.random(n) + np.arange(n)) / n
+  return np.minimum(np.searchsorted(np.cumsum(probabilities), u), len(probabilities) - 1)
+
+# Keeps floor(n * p) copies of each particle, and draws the rest from the residual weights
+def residual_resampling(rng: np.random.Generator, probabilities: np.ndarray, n: int) -> np.ndarray:
+  counts = np.floor(n * probabilities).astype(int)
+  idxs = np.repeat(np.arange(len(probabilities)), counts)
+  n_rest = n - len(idxs)
+  if n_rest == 0:
+    return idxs
+  residuals = n * probabilities - counts
+  rest = multinomial_resampling(rng, residuals / residuals.sum(), n_rest)
+  return np.concatenate([idxs, rest])
+
+resampling_schemes: Dict[str, Callable[[np.random.Generator, np.ndarray, int], np.ndarray]] = {
+  'multinomial': multinomial_resampling,
+  'systematic': systematic_resampling,
+  'stratified': stratified_resampling,
+  'residual': residual_resampling,
+}
+
+# Seed of the particle at the given index after the given number of resamples, so that
+# the values drawn do not depend on the order or the process particles are evaluated in
+def particle_seed(seed: np.random.SeedSequence, generation: int, i: int) -> np.random.SeedSequence:
+  return np.random.SeedSequence(seed.entropy, spawn_key=(*seed.spawn_key, generation, i))
 
 # A set of particles, returns a Mixture distribution
 class ProbState(object):
@@ -584,12 +901,32 @@ class ProbState(object):
     method: type[SymState], 
     value_f: Callable[[RandomVar], Const],
     seed: Optional[int] = None,
+    resampling: str = 'multinomial',
+    ess_threshold: Optional[float] = None,
+    compress: bool = False,
+    gc_growth: Optional[float] = 2.,
   ) -> None:
     super().__init__()
     self.seed = seed
-    self.rng = np.random.default_rng(seed=seed)
+    # Resampling and the particles draw from independent streams
+    resample_seed, self.particle_seed = np.random.SeedSequence(seed).spawn(2)
+    self.rng = np.random.default_rng(resample_seed)
+    # Number of times the particles were resampled
+    self.generation: int = 0
+    self.resampling: str = resampling
+    # Fraction of the particles the effective sample size must drop below to resample,
+    # always resampling if None
+    self.ess_threshold: Optional[float] = ess_threshold
+    # Whether resampling keeps a single particle with a count for the copies of a particle
+    self.compress: bool = compress
+    # Factor the state of a particle must grow by since its last collection for the
+    # variables it cannot reach to be collected at a resample point, never collecting if None
+    self.gc_growth: Optional[float] = gc_growth
+    # Encodings of the program variables in the particles as of the last resample point:
+    # whether they were sampled, or None if they were in some particles and not in others
+    self.encodings: Dict[Identifier, Optional[bool]] = {}
     self.particles: List[Particle] = [
-      Particle(cont, method(value_f, seed=seed)) for i in range(n_particles)
+      Particle(cont, method(value_f, seed=particle_seed(self.particle_seed, 0, i))) for i in range(n_particles)
     ]
 
   @staticmethod
@@ -600,7 +937,9 @@ class ProbState(object):
 
   def __copy__(self) -> 'ProbState':
     # doesn't really matter what goes in constructor, since it will be overwritten
-    new_state = ProbState(1, self.particles[0].cont, type(self.particles[0].state), seed=self.seed)
+    new_state = ProbState(1, self.particles[0].cont, type(self.particles[0].state), seed=self.seed,
+                          resampling=self.resampling, ess_threshold=self.ess_threshold,
+                          compress=self.compress, gc_growth=self.gc_growth)
     new_state.particles = [copy(p) for p in self.particles]
     return new_state
 
@@ -635,9 +974,17 @@ class ProbState(object):
     
     # return "\n".join([f"{i}: {p}" for i, p in enumerate(self.particles)])
   
-  # Normalize the probabilities of the particles based on their scores
+  # Scores of the particles, in logscale
+  def scores(self) -> np.ndarray:
+    return np.array([p.score for p in self.particles])
+
+  # Number of particles each particle stands for
+  def counts(self) -> np.ndarray:
+    return np.array([p.count for p in self.particles])
+
+  # Normalize the probabilities of the particles based on their scores and counts
   def normalized_probabilities(self) -> List[float]:
-    scores = np.array([p.score for p in self.particles])
+    scores = self.scores() + np.log(self.counts())
     if np.max(scores) == -np.inf:
       warnings.warn("All particles have 0 weight")
       scores = np.zeros(len(scores))
@@ -645,10 +992,11 @@ class ProbState(object):
     probabilities = np.exp(scores - np.max(scores))
     return list(probabilities / probabilities.sum())
   
-  # Create the mixture distribution of the particles
-  def mixture(self) -> Mixture:
+  # Create the mixture distribution of the particles, over their results by default
+  def mixture(self, values: Optional[List[SymExpr]] = None) -> Mixture:
     probabilities = self.normalized_probabilities()
-    values = [p.final_expr for p in self.particles]
+    if values is None:
+      values = [p.final_expr for p in self.particles]
     states = [p.state for p in self.particles]
 
     unique_values = Mixture(list(zip(values, states, probabilities)))
@@ -657,8 +1005,12 @@ class ProbState(object):
 
   # Compute the expectation of the result of the particles
   # Pairs and Lists are handled recursively
-  def result(self) -> SymExpr:
-    mixture = self.mixture()
+  def result(self, values: Optional[List[SymExpr]] = None) -> SymExpr:
+    if len(self.particles) > 1:
+      res = self.batched_result(values)
+      if res is not None:
+        return res
+    mixture = self.mixture(values)
     
     def _get_mean(res: Mixture) -> Const:
       if res.is_pair_mixture:
@@ -674,26 +1026,101 @@ class ProbState(object):
       
     return _get_mean(mixture)
 
+  # Compute the expectation of results with the same structure at once, from the means of
+  # the values of all particles in an array, with a column per position in the results
+  def batched_result(self, values: Optional[List[SymExpr]] = None) -> Optional[SymExpr]:
+    if values is None:
+      values = [p.final_expr for p in self.particles]
+    structure = _split_result(values[0], [])
+    rows = []
+    for expr, p in zip(values, self.particles):
+      row = []
+      if _split_result(expr, row) != structure:
+        return None
+      row = p.state.means(row)
+      if not all(isinstance(v, Number) for v in row):
+        return None
+      rows.append(row)
+
+    means = np.array(rows, dtype=float).reshape(len(rows), -1)
+    totals = np.asarray(self.normalized_probabilities()) @ means
+    return Const(_join_result(structure, iter(totals)))
+
+  # Compute the expectation of a variable where the particles are interrupted
+  def posterior(self, name: Identifier) -> SymExpr:
+    return self.result([p.state.ctx[name] for p in self.particles])
+
   @property
   def finished(self) -> bool:
     return all(p.finished for p in self.particles)
+
+  # Whether the unfinished particles are all waiting for rows to be fed
+  @property
+  def waiting(self) -> bool:
+    return all(p.finished or p.waiting for p in self.particles)
   
+  # Effective sample size of the particles, from their normalized weights
+  # (split evenly between the particles a particle stands for)
+  def ess(self) -> float:
+    probabilities = np.asarray(self.normalized_probabilities())
+    return 1. / np.sum(probabilities ** 2 / self.counts())
+
+  # Whether the particles should be resampled at a resample point. Otherwise their
+  # scores keep accumulating until the next one
+  def should_resample(self) -> bool:
+    if self.ess_threshold is None:
+      return True
+    return self.ess() < self.ess_threshold * self.counts().sum()
+
+  # Merges the encodings of the program variables in the particles
+  def merge_encodings(self) -> Dict[Identifier, Optional[bool]]:
+    encodings: Dict[Identifier, Optional[bool]] = {}
+    for p in self.particles:
+      for pv, sampled in p.state.encodings.items():
+        encodings[pv] = sampled if encodings.get(pv, sampled) is sampled else None
+    self.encodings = encodings
+    return encodings
+
+  # Collects the variables the unfinished particles cannot reach, in the states that grew
+  # enough since their last collection, so the states stay bounded by what is reachable
+  def collect(self) -> None:
+    if self.gc_growth is None:
+      return
+    for p in self.particles:
+      if not p.finished and len(p.state) > self.gc_growth * p.state.live:
+        p.state.clean(p.roots())
+
+  # Indices of the particles to keep, drawn with the resampling scheme
+  def resample_indices(self, n: int) -> np.ndarray:
+    probabilities = np.asarray(self.normalized_probabilities())
+    return resampling_schemes[self.resampling](self.rng, probabilities, n)
+
   # Resamples its set of particles based on their scores, resetting the scores at the end.
   def resample(self) -> 'ProbState':
     particles = self.particles
-    probabilities = self.normalized_probabilities()
-    idxs = self.rng.choice(np.arange(len(particles)), size=len(particles),
-                            replace=True, p=probabilities)
-    used_idxs = set()
-    new_particles = []
-    for idx in idxs:
-      if idx not in used_idxs:
-        new_particles.append(particles[idx])
-        used_idxs.add(idx)
-      else:
-        new_particles.append(copy(particles[idx]))
-    self.particles = new_particles
+    if self.compress:
+      # Particles drawn several times are kept once, with the number of times drawn
+      idxs = self.resample_indices(self.counts().sum())
+      counts = np.bincount(idxs, minlength=len(particles))
+      self.particles = [particles[idx].update(score=0.) for idx in np.flatnonzero(counts)]
+      for p, count in zip(self.particles, counts[counts > 0]):
+        p.count = int(count)
+      self.reseed()
+      return self
+
+    idxs = self.resample_indices(len(particles))
+    # The first occurrence of each particle is kept, the others are copies
+    first = np.zeros(len(idxs), dtype=bool)
+    first[np.unique(idxs, return_index=True)[1]] = True
+    self.particles = [particles[idx] if keep else copy(particles[idx]) for idx, keep in zip(idxs, first)]
     for p in self.particles:
       p.update(score=0.)
+    self.reseed()
     return self
+
+  # Gives the resampled particles the streams of their new index
+  def reseed(self) -> None:
+    self.generation += 1
+    for i, p in enumerate(self.particles):
+      p.state.reseed(particle_seed(self.particle_seed, self.generation, i))
   
\ No newline at end of file
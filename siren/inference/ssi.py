@@ -78,18 +78,18 @@ class SSIState(SymState):
     
   ########################################################################
 
-  def parents(self, rv: RandomVar) -> List[RandomVar]:
+  def parents(self, rv: RandomVar) -> Tuple[RandomVar, ...]:
     return self.distr(rv).rvs()
     
   def score(self, rv: RandomVar[T], v: T) -> float:
     # RV has to be root
     self.hoist_and_eval(rv)
-    return self.distr(rv).score(v)
+    return self.score_distr(self.distr(rv), v)
 
   def draw(self, rv: RandomVar) -> Any:
     # RV has to be root
     self.hoist_and_eval(rv)
-    return self.distr(rv).draw(self.rng)
+    return self.draw_distr(self.distr(rv))
 
   def intervene(self, rv: RandomVar[T], v: Delta[T]) -> None:
     self.set_distr(rv, v)
@@ -161,15 +161,19 @@ class SSIState(SymState):
     # Topological sort of the random variables
     def _topo_sort(rvs: List[RandomVar]) -> List[RandomVar]:
       sorted_nodes = []
+      visited = set()
 
       def _visit(rv: RandomVar) -> None:
+        # Shared ancestors are only visited once
+        if rv in visited:
+          return
+        visited.add(rv)
         parents = self.parents(rv)
 
         for parent in parents:
           _visit(parent)
 
-        if rv not in sorted_nodes:
-          sorted_nodes.append(rv)
+        sorted_nodes.append(rv)
 
       for rv in rvs:
         _visit(rv)
@@ -0,0 +1,258 @@
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+
+from siren.grammar import *
+from siren.probability import lgamma_array, logbeta_array, logcomb_array
+from siren.utils import is_pair, is_lst, get_pair, get_lst
+from siren.inference.interface import SymState, Context, ProbState, PMap
+
+# Vectorized particles: a single particle stands for all the particles, each constant
+# holding the values of all the particles in an array. The symbolic state operations
+# and conjugate updates then run once for all the particles, with array arithmetic.
+# This holds as long as the particles take the same branches and have the same
+# symbolic structure, otherwise evaluation raises Divergence
+
+# Raised when the particles would not evaluate the same way
+class Divergence(Exception):
+  pass
+
+# Values of a constant for each particle
+class Vec(np.ndarray):
+  # A condition holds if it holds for all particles and fails if it fails for all of them
+  def __bool__(self) -> bool:
+    values = self.view(np.ndarray)
+    if values.all():
+      return True
+    if not values.any():
+      return False
+    raise Divergence('particles take different branches')
+
+  # Only a value shared by all particles converts to a scalar
+  def __int__(self) -> int:
+    return int(scalar(self))
+
+  def __float__(self) -> float:
+    return float(scalar(self))
+
+  def __index__(self) -> int:
+    return int(scalar(self))
+
+  def __str__(self) -> str:
+    return str(self.view(np.ndarray))
+
+# Value of a constant, which has to be the same for all particles
+def scalar(v: Any) -> Any:
+  if not isinstance(v, Vec):
+    return v
+  values = v.view(np.ndarray)
+  if values.size > 0 and (values == values.flat[0]).all():
+    return values.flat[0].item()
+  raise Divergence('particles have different values')
+
+# Vectorized version of SymDistr.score, over the values of all particles
+def _score(distribution: SymDistr, v: Any) -> Any:
+  match distribution:
+    case Normal():
+      mu, var = distribution.marginal_parameters()
+      return -0.5 * np.log(2 * np.pi * var) - ((v - mu) ** 2) / (2 * var)
+    case Bernoulli():
+      p = distribution.marginal_parameters()
+      return np.where(v, np.log(p), np.log(1 - p))
+    case Beta():
+      a, b = distribution.marginal_parameters()
+      s = -logbeta_array(a, b) + (a - 1) * np.log(v) + (b - 1) * np.log(1 - v)
+      return np.where((v >= 0) & (v <= 1), s, -np.inf)
+    case Binomial():
+      n, p = distribution.marginal_parameters()
+      s = logcomb_array(n, v) + v * np.log(p) + (n - v) * np.log(1 - p)
+      return np.where((v >= 0) & (v <= n), s, -np.inf)
+    case BetaBinomial():
+      n, a, b = distribution.marginal_parameters()
+      s = logcomb_array(n, v) + logbeta_array(v + a, n - v + b) - logbeta_array(a, b)
+      return np.where((v >= 0) & (v <= n), s, -np.inf)
+    case NegativeBinomial():
+      n, p = distribution.marginal_parameters()
+      s = logcomb_array(v + n - 1, v) + n * np.log(p) + v * np.log(1 - p)
+      return np.where(v >= 0, s, -np.inf)
+    case Gamma():
+      a, b = distribution.marginal_parameters()
+      s = (a - 1) * np.log(v) - b * v - lgamma_array(a) + a * np.log(b)
+      return np.where(v >= 0, s, -np.inf)
+    case Poisson():
+      l = distribution.marginal_parameters()
+      s = v * np.log(l) - l - lgamma_array(v + 1)
+      return np.where(v >= 0, s, -np.inf)
+    case StudentT():
+      mu, tau2, nu = distribution.marginal_parameters()
+      return lgamma_array((nu + 1) / 2) - lgamma_array(nu / 2) - 0.5 * np.log(nu) - 0.5 * np.log(np.pi) \
+        - 0.5 * np.log(tau2) - 0.5 * (nu + 1) * np.log(1 + (v - mu) ** 2 / (nu * tau2))
+    case Categorical():
+      lower, _, probs = distribution.marginal_parameters()
+      return np.log(np.asarray(probs))[np.asarray(v - lower, dtype=int)]
+    case Delta():
+      inner_v = distribution.marginal_parameters()
+      return np.where(v == inner_v, 0., -np.inf)
+    case _:
+      raise ValueError(distribution)
+
+# Vectorized version of SymDistr.draw, drawing n values
+def _draw(distribution: SymDistr, rng: np.random.Generator, n: int) -> Any:
+  match distribution:
+    case Normal():
+      mu, var = distribution.marginal_parameters()
+      return rng.normal(mu, np.sqrt(var), size=n)
+    case Bernoulli():
+      p = distribution.marginal_parameters()
+      return rng.binomial(1, p, size=n).astype(bool)
+    case Beta():
+      a, b = distribution.marginal_parameters()
+      return rng.beta(a, b, size=n)
+    case Binomial():
+      n_trials, p = distribution.marginal_parameters()
+      return rng.binomial(n_trials, p, size=n)
+    case BetaBinomial():
+      n_trials, a, b = distribution.marginal_parameters()
+      return rng.binomial(n_trials, rng.beta(a, b, size=n))
+    case NegativeBinomial():
+      n_trials, p = distribution.marginal_parameters()
+      return rng.negative_binomial(n_trials, p, size=n)
+    case Gamma():
+      a, b = distribution.marginal_parameters()
+      return rng.gamma(a, 1 / b, size=n)
+    case Poisson():
+      l = distribution.marginal_parameters()
+      return rng.poisson(l, size=n)
+    case StudentT():
+      mu, tau2, nu = distribution.marginal_parameters()
+      return rng.standard_t(nu, size=n) * np.sqrt(tau2) + mu
+    case Categorical():
+      lower, upper, probs = distribution.marginal_parameters()
+      return rng.choice(range(lower, upper + 1), p=probs, size=n)
+    case Delta():
+      return distribution.marginal_parameters()
+    case _:
+      raise ValueError(distribution)
+
+# Symbolic state of vectorized particles, mixed into the state of an inference method
+class VectorizedState(SymState):
+  def __init__(self, value_f, seed=None, n: int = 1) -> None:
+    super().__init__(value_f, seed=seed)
+    self.n: int = n
+
+  def __copy__(self):
+    new_state = super().__copy__()
+    new_state.n = self.n
+    return new_state
+
+  def score_distr(self, distribution: SymDistr[T], v: T) -> Any:
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return _score(distribution, v)
+
+  def draw_distr(self, distribution: SymDistr[T]) -> Any:
+    v = _draw(distribution, self.rng, self.n)
+    return v.view(Vec) if isinstance(v, np.ndarray) else v
+
+  def mean(self, expr: SymExpr) -> Any:
+    expr = self.eval(expr)
+    match expr:
+      case RandomVar(_):
+        self.marginalize(expr)
+        match self.get_entry(expr, 'distribution'):
+          case Delta(Const(v)) if isinstance(v, Vec):
+            return v
+          case distribution:
+            return distribution.mean()
+      case _:
+        return super().mean(expr)
+
+_vectorized_methods: Dict[type[SymState], type[SymState]] = {}
+
+# Vectorized version of the state of an inference method
+def vectorized(method: type[SymState]) -> type[SymState]:
+  if method not in _vectorized_methods:
+    _vectorized_methods[method] = type(f'Vectorized{method.__name__}', (VectorizedState, method), {})
+  return _vectorized_methods[method]
+
+# Selects the values of the given particles in all the constants reachable from x,
+# keeping the objects that do not depend on the particles
+def _take(x: Any, idxs: np.ndarray, memo: Dict[int, Any]) -> Any:
+  key = id(x)
+  if key in memo:
+    return memo[key]
+  match x:
+    case Vec():
+      new = x[idxs]
+    case PList():
+      heads = [_take(e, idxs, memo) for e in x]
+      changed = any(h is not e for h, e in zip(heads, x))
+      new = PList.of(heads) if changed else x
+    case SymExpr():
+      fields = [getattr(x, f) for f in x.__match_args__]
+      new_fields = [_take(f, idxs, memo) for f in fields]
+      changed = any(nf is not f for nf, f in zip(new_fields, fields))
+      new = type(x)(*new_fields) if changed else x
+    case Context():
+      new = Context(_take(x.context, idxs, memo))
+    case PMap():
+      new = PMap.of((k, _take(v, idxs, memo)) for k, v in x.items())
+    case dict():
+      new = {k: _take(v, idxs, memo) for k, v in x.items()}
+    case list():
+      new = [_take(v, idxs, memo) for v in x]
+    case tuple():
+      new = tuple(_take(v, idxs, memo) for v in x)
+    case _:
+      new = x
+  memo[key] = new
+  return new
+
+# A set of particles evaluated as one vectorized particle
+class VectorizedProbState(ProbState):
+  def __init__(
+    self,
+    n_particles: int,
+    cont: Expr,
+    method: type[SymState],
+    value_f: Callable[[RandomVar], Const],
+    seed: Optional[int] = None,
+    resampling: str = 'multinomial',
+    ess_threshold: Optional[float] = None,
+    gc_growth: Optional[float] = 2.,
+  ) -> None:
+    super().__init__(1, cont, vectorized(method), value_f, seed, resampling, ess_threshold, gc_growth=gc_growth)
+    self.n_particles: int = n_particles
+    self.particles[0].state.n = n_particles
+
+  def scores(self) -> np.ndarray:
+    return np.broadcast_to(np.asarray(self.particles[0].score, dtype=float), (self.n_particles,))
+
+  def counts(self) -> np.ndarray:
+    return np.ones(self.n_particles, dtype=int)
+
+  def resample(self) -> 'ProbState':
+    idxs = self.resample_indices(self.n_particles)
+    particle = self.particles[0]
+    memo: Dict[int, Any] = {}
+    particle.state.state = _take(particle.state.state, idxs, memo)
+    particle.state.ctx = _take(particle.state.ctx, idxs, memo)
+    particle.stack = _take(particle.stack, idxs, memo)
+    particle.update(cont=_take(particle.cont, idxs, memo), score=0.)
+    return self
+
+  # Weighted mean of the results of all particles, as ProbState.result
+  def result(self, values: Optional[List[SymExpr]] = None) -> SymExpr:
+    particle = self.particles[0]
+    expr = particle.final_expr if values is None else values[0]
+    weights = np.asarray(self.normalized_probabilities())
+
+    def _get_mean(expr: SymExpr) -> Const:
+      if is_pair(expr):
+        fst, snd = get_pair(expr)
+        return Const((_get_mean(fst).v, _get_mean(snd).v))
+      elif is_lst(expr):
+        return Const([_get_mean(e).v for e in get_lst(expr)])
+      else:
+        mean = np.broadcast_to(particle.state.mean(expr), weights.shape)
+        return Const(np.dot(weights, mean.view(np.ndarray)))
+
+    return _get_mean(expr)
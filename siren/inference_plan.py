@@ -125,26 +125,23 @@ class InferencePlan(object):
     else:
       raise ValueError(__value)
     
-# Get the distribution encodings for a particle
-def distribution_encodings(particle: Particle) -> InferencePlan:
+# Get the inference plan from the encodings of the program variables
+def encodings_plan(encodings: Dict[Identifier, Optional[bool]]) -> InferencePlan:
   inf_plan = InferencePlan()
-  for rv in particle.state:
-    pv = particle.state.get_entry(rv, 'pv')
-    if pv is None:
-      continue
-
-    if particle.state.is_sampled(rv):
-      inf_plan[pv] = DistrEnc.sample
-    else:
-      if pv in inf_plan and inf_plan[pv] == DistrEnc.sample:
-        continue
-      inf_plan[pv] = DistrEnc.symbolic
+  for pv, sampled in encodings.items():
+    match sampled:
+      case True:
+        inf_plan[pv] = DistrEnc.sample
+      case False:
+        inf_plan[pv] = DistrEnc.symbolic
+      case None:
+        inf_plan[pv] = DistrEnc.dynamic
   return inf_plan
+
+# Get the distribution encodings for a particle
+def distribution_encodings(particle: Particle) -> InferencePlan:
+  return encodings_plan(particle.state.encodings)
     
 # Get the runtime inference plan by inspecting the particles
 def runtime_inference_plan(prob: ProbState) -> InferencePlan:
-    inf_plan = InferencePlan()
-    for particle in prob.particles:
-      ip = distribution_encodings(particle)
-      inf_plan = inf_plan | ip
-    return inf_plan
\ No newline at end of file
+    return encodings_plan(prob.merge_encodings())
@@ -1,70 +1,75 @@
 from typing import Any, Optional, List
+import os
+import hashlib
+import pickle
+import shutil
+import tempfile
+import warnings
 import lark
 
+import siren.grammar
 from siren.grammar import *
 
-parser = lark.Lark(r'''
+# Operators bind from loosest to tightest: comparisons, cons, sums, products.
+# let and if extend as far to the right as possible, so `if c then a else b + 1.` parses
+# as `if c then a else (b + 1.)`
+grammar = r'''
 start: func* expression -> program
                    
 func: "val" NAME "=" "fun" patternlist "->" expression "in"
                    
-expression: 
-  | "true" -> true
+?expression: comparison
+  | "let" patternlist "=" expression "in" expression -> let
+  | "let" rvpattern "<-" expression "in" expression -> letrv
+  | "if" expression "then" expression "else" expression -> ifelse
+
+?comparison: cons
+  | comparison "=" cons -> eq
+  | comparison "<" cons -> lt
+
+?cons: sum
+  | sum "::" cons -> cons
+
+?sum: product
+  | sum "+" product -> add
+  | sum "-" product -> sub
+
+?product: atom
+  | product "*" atom -> mul
+  | product "/" atom -> div
+
+?atom: "true" -> true
   | "false" -> false
   | "(" ")" -> nil
   | NUMBER -> number
-  | INTEGER -> integer
   | STRING -> string
   | NAME -> variable
   | "(" expression ("," expression)* ")" -> pair
-  | "let" patternlist "=" expression "in" expression -> let
-  | ops -> ops
   | identifier args -> apply
-  | "if" expression "then" expression "else" expression -> ifelse
   | "fold" "(" identifier "," expression "," expression ")" -> fold
-  | "let" rvpattern "<-" expression "in" expression -> letrv
   | "observe" "(" expression "," expression ")" -> observe
   | "resample" "(" ")" -> resample
   | list -> list
                    
-args:
-  | "(" ")" -> nil
+args: "(" ")" -> nil
   | "(" expression ("," expression)* ")" -> expressionlist
                    
-list: 
-  | "[" "]" -> nil
+list: "[" "]" -> nil
   | "nil" -> nil
   | "[" expression ("," expression)* "]" -> list
 
-rvpattern:
-  | "sample" identifier -> sample
+rvpattern: "sample" identifier -> sample
   | "symbolic" identifier -> symbolic
   | identifier -> identifier
-                   
-ops:
-  | expression "+" expression -> add
-  | expression "-" expression -> sub
-  | expression "*" expression -> mul
-  | expression "/" expression -> div
-  | expression "::" expression -> cons
-  | expression "=" expression -> eq
-  | expression "<" expression -> lt
-
-patternlist:
-  | "(" ")" -> nil
-  | "(" patternlist ")" -> paren
-  | pattern -> pattern
+
+patternlist: pattern -> pattern
   | pattern ("," pattern)+ -> patternlist
                    
-pattern:
-  | NAME -> identifier
-  | "_" -> wildcard
+pattern: NAME -> identifier
   | "(" ")" -> nil
-  | "(" pattern ")" -> paren
-  | "(" pattern ("," pattern)+ ")" -> patternlist
+  | "(" patternlist ")" -> paren
                    
-identifier: 
-  | NAME -> ident
+identifier: NAME -> ident
   | NAME "." NAME -> module
                    
 %import common.SH_COMMENT -> COMMENT        
@@ -76,13 +81,97 @@ BLOCK_COMMENT: "(*" /((?!\*\)).|\n)+/ "*)"
 %import common.CNAME -> NAME
 %import common.ESCAPED_STRING -> STRING
 %import common.SIGNED_NUMBER -> NUMBER
-%import common.INT -> INTEGER
 %import common.WS
 %ignore WS
-''')
+'''
 
-# Parse Siren program (string) into AST
+# Parsed programs and the LALR parser tables are cached on disk, in a directory of the user's
+# cache that others cannot write to, as the cache is unpickled. Parsed programs are kept in a
+# subdirectory keyed by the hash of the modules defining the parser and the AST and by the
+# lark version, and each of them by the hash of its source
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'siren')
+
+# Most parsed programs kept in the cache
+CACHE_SIZE = 256
+
+# Creates the cache directory, returning None if it cannot be created or is not private to the user
+def _cache_dir() -> Optional[str]:
+  try:
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    st = os.stat(CACHE_DIR)
+  except OSError:
+    return None
+  if hasattr(os, 'getuid') and (st.st_uid != os.getuid() or st.st_mode & 0o077):
+    return None
+  return CACHE_DIR
+
+def _version() -> str:
+  h = hashlib.sha256()
+  for module in (__file__, siren.grammar.__file__):
+    with open(module, 'rb') as f:
+      h.update(f.read())
+  h.update(lark.__version__.encode())
+  return h.hexdigest()
+
+def _make_parser() -> lark.Lark:
+  cache_dir = _cache_dir()
+  cache = os.path.join(cache_dir, f'lark-{lark.__version__}.tmp') if cache_dir is not None else False
+  return lark.Lark(grammar, parser='lalr', cache=cache)
+
+parser = _make_parser()
+
+# Returns the directory of the programs parsed by this version, removing the ones of other versions
+def _programs_dir(cache_dir: str) -> str:
+  version = _version()
+  for entry in os.listdir(cache_dir):
+    if entry.startswith('programs-') and entry != f'programs-{version}':
+      shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+  path = os.path.join(cache_dir, f'programs-{version}')
+  os.makedirs(path, mode=0o700, exist_ok=True)
+  return path
+
+# Parse Siren program (string) into AST, using the cached AST if the program was parsed before
 def parse_program(program: str) -> Program:
+  cache_dir = _cache_dir()
+  if cache_dir is None:
+    return _parse_program(program)
+
+  try:
+    programs_dir = _programs_dir(cache_dir)
+  except OSError:
+    return _parse_program(program)
+  path = os.path.join(programs_dir, f'{hashlib.sha256(program.encode()).hexdigest()}.pkl')
+  try:
+    with open(path, 'rb') as f:
+      ast = pickle.load(f)
+    os.utime(path)
+    return ast
+  except FileNotFoundError:
+    pass
+  except (OSError, EOFError, pickle.UnpicklingError) as e:
+    warnings.warn(f'Ignoring corrupt parser cache entry {path}: {e}')
+
+  ast = _parse_program(program)
+
+  # Writes to a temporary file first so concurrent runs never read a partial cache,
+  # then evicts the least recently used programs
+  try:
+    fd, tmp = tempfile.mkstemp(dir=programs_dir)
+    with os.fdopen(fd, 'wb') as f:
+      pickle.dump(ast, f)
+    os.replace(tmp, path)
+
+    entries = [os.path.join(programs_dir, entry) for entry in os.listdir(programs_dir) if entry.endswith('.pkl')]
+    if len(entries) > CACHE_SIZE:
+      entries.sort(key=os.path.getmtime)
+      for entry in entries[:len(entries) - CACHE_SIZE]:
+        os.remove(entry)
+  except OSError:
+    pass
+  return ast
+
+# Parse Siren program (string) into AST
+def _parse_program(program: str) -> Program:
   parse_tree = parser.parse(program + '\n')
 
   # Makes an identifier, which can have a Module name
@@ -184,6 +273,9 @@ def parse_program(program: str) -> Program:
     elif x.data == "lt":
       left, right = x.children
       return GenericOp(Operator.lt, [_make_expression(left), _make_expression(right)])
+    elif x.data == "cons":
+      left, right = x.children
+      return GenericOp(Operator.cons, [_make_expression(left), _make_expression(right)])
     elif x.data == "apply":
       identifier, args = x.children
       identifier = _make_identifier(identifier)
@@ -198,8 +290,6 @@ def parse_program(program: str) -> Program:
   def _make_expression(x: Any) -> Expr:
     if x.data == "number":
       return Const(float(x.children[0].value))
-    elif x.data == "integer":
-      return Const(int(x.children[0].value))
     elif x.data == "string":
       return Const(str(x.children[0].value.strip('"')))
     elif x.data == "nil":
@@ -213,8 +303,8 @@ def parse_program(program: str) -> Program:
       return Identifier(None, str(identifier))
     elif x.data == "pair":
       return _make_pairs(x.children)
-    elif x.data == "ops":
-      return _make_ops(x.children[0])
+    elif x.data in ("add", "sub", "mul", "div", "eq", "lt", "cons"):
+      return _make_ops(x)
     elif x.data == "apply":
       identifier, args = x.children
       identifier = _make_identifier(identifier)
@@ -257,8 +347,6 @@ def parse_program(program: str) -> Program:
       return Resample()
     elif x.data == "list":
       return _make_list(x.children[0])
-    elif x.data == "expression":
-      return _make_expression(x.children[0])
     else:
       raise ValueError(x.data)
 
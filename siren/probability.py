@@ -1,7 +1,16 @@
 import math
+import numpy as np
 
 def logcomb(n, k):
   return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
 
 def logbeta(a, b):
-  return math.lgamma(a) + math.lgamma(b) - math.lgamma(a + b)
\ No newline at end of file
+  return math.lgamma(a) + math.lgamma(b) - math.lgamma(a + b)
+# Versions of the above over arrays of values
+lgamma_array = np.vectorize(math.lgamma, otypes=[float])
+
+def logcomb_array(n, k):
+  return lgamma_array(n + 1) - lgamma_array(k + 1) - lgamma_array(n - k + 1)
+
+def logbeta_array(a, b):
+  return lgamma_array(a) + lgamma_array(b) - lgamma_array(a + b)
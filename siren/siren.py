@@ -2,14 +2,15 @@ import argparse
 import os
 import time
 import cProfile
+import tracemalloc
 
 from . import parser
 from .analyze import AbsSMC, AbsMH, AnalysisExit
-from .evaluate import SMC, MH
+from .evaluate import SMC, VectorizedSMC, MH
 from .inference import SSIState, DSState, BPState
+from .inference.interface import resampling_schemes
 from .analysis import AbsSSIState, AbsDSState, AbsBPState
 from .inference_plan import runtime_inference_plan
-import sys
 
 # Maps the command line arguments to the symbolic state classes
 method_states = {
@@ -20,21 +21,26 @@ method_states = {
 
 handlers = {
     'smc': (SMC, AbsSMC),
+    'vsmc': (VectorizedSMC, AbsSMC),
     'mh': (MH, AbsMH),
 }
 
 def main():
-    sys.setrecursionlimit(5000)
     p = argparse.ArgumentParser()
     p.add_argument("filename", type=str)
     p.add_argument("--verbose", "-v", action="store_true")
     p.add_argument("--particles", "-p", type=int, default=100, help="Number of particles to use during SMC inference")
+    p.add_argument("--resampling", "-r", type=str, default="multinomial", choices=list(resampling_schemes), help="Resampling scheme to use during SMC inference")
+    p.add_argument("--ess-threshold", type=float, default=None, help="Only resample during SMC inference when the effective sample size is below this fraction of the particles")
+    p.add_argument("--jobs", "-j", type=int, default=1, help="Number of worker processes to evaluate the particles with during SMC inference")
+    p.add_argument("--compress", action="store_true", help="Evaluate the copies made by resampling during SMC inference once, until they draw different values")
+    p.add_argument("--no-gc", action="store_true", help="Keep the random variables the particles cannot reach during SMC inference, instead of collecting them at resample points")
     p.add_argument("--samples", type=int, default=100, help="Number of samples to use during MH inference")
     p.add_argument("--warmup", "-w", type=int, default=0, help="Number of warmup samples to use during MH inference")
     p.add_argument("--thinning", "-t", type=int, default=1, help="Thining factor to use during MH inference")
     p.add_argument("--analyze", "-a", action="store_true", help="Apply the inference plan satisfiability analysis during compilation")
     p.add_argument("--analyze-only", "-ao", action="store_true", help="Only apply the inference plan satisfiability analysis, does not run the program")
-    p.add_argument("--handler", "-l", type=str, default="smc", choices=["smc", "mh"])
+    p.add_argument("--handler", "-l", type=str, default="smc", choices=["smc", "vsmc", "mh"])
     p.add_argument(
         "--method",
         "-m",
@@ -45,6 +51,7 @@ def main():
     p.add_argument("--seed", "-s", type=int, default=None)
     p.add_argument("--max-rvs", type=int, default=4, help="Maximum number of random variables to track in abstract expression types")
     p.add_argument("--profile", action="store_true", help="Profile the program")
+    p.add_argument("--memory", action="store_true", help="Report the peak memory used per particle during inference")
     args = p.parse_args()
 
     with open(args.filename, "r") as f:
@@ -58,6 +65,8 @@ def main():
     match args.handler:
         case "smc":
             print("SMC")
+        case "vsmc":
+            print("Vectorized SMC")
         case "mh":
             print("MH")
         case _:
@@ -97,12 +106,14 @@ def main():
         file_dir = os.path.dirname(os.path.realpath(args.filename))
         if args.profile:
             cProfile.runctx(
-                "handler.infer(program, inference_method, file_dir, args.seed, n_particles=args.particles, n_samples=args.samples, n_warmups=args.warmup, n_thinning=args.thinning)",
+                "handler.infer(program, inference_method, file_dir, args.seed, n_particles=args.particles, resampling=args.resampling, ess_threshold=args.ess_threshold, compress=args.compress, gc_growth=None if args.no_gc else 2., n_jobs=args.jobs, n_samples=args.samples, n_warmups=args.warmup, n_thinning=args.thinning)",
                 globals(),
                 locals(),
                 sort="cumtime",
             )
             return
+        if args.memory:
+            tracemalloc.start()
         t1 = time.time()
         # try:
         res, probstate = handler().infer(
@@ -111,6 +122,11 @@ def main():
             file_dir,
             args.seed,
             n_particles=args.particles,
+            resampling=args.resampling,
+            ess_threshold=args.ess_threshold,
+            compress=args.compress,
+            gc_growth=None if args.no_gc else 2.,
+            n_jobs=args.jobs,
             n_samples=args.samples,
             n_warmups=args.warmup,
             n_thinning=args.thinning,
@@ -119,6 +135,14 @@ def main():
         print("===== Evaluation Time =====")
         print(f"{t2 - t1}")
 
+        if args.memory:
+            # Peak memory traced during inference
+            _, size = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            n = args.particles if args.handler in ("smc", "vsmc") else args.samples
+            print("===== Peak Memory Per Particle =====")
+            print(f"{size / n}")
+
         print("===== Result =====")
         print(res)
 
@@ -16,13 +16,70 @@ def fast_copy(d: Dict[Any, Any]) -> Dict[Any, Any]:
       new_d[k] = v
   return new_d
 
-def get_lst(l: Expr[SymExpr]) -> List[SymExpr]:
+# Purity of every expression of the program, keyed by the id of the expression.
+# An expression is pure if evaluating it does not resample or observe.
+# Computed once per program and shared by evaluation and analysis
+def purity(program: Program) -> Dict[int, bool]:
+  if len(program.purity) > 0:
+    return program.purity
+
+  # Functions are pure until their body is found impure, which also handles recursion
+  functions = {f.name: True for f in program.functions}
+
+  def _pure(expr: Expr) -> bool:
+    # Visits all subexpressions so that each of them is in the table
+    match expr:
+      case SymExpr() | AbsSymExpr():
+        # All symbolic expressions are pure
+        p = True
+      case Resample():
+        p = False
+      case Observe(distribution, v):
+        _pure(distribution)
+        _pure(v)
+        p = False
+      case Identifier(_, _):
+        p = True
+      case GenericOp(_, args):
+        p = all([_pure(arg) for arg in args])
+      case Fold(func, init, acc):
+        p = all([_pure(init), _pure(acc)]) and functions.get(func, True)
+      case Apply(func, args):
+        # Library functions are pure, but can apply the functions given as arguments
+        p = all([_pure(arg) for arg in args]) and functions.get(func, True) \
+          and all(functions.get(arg, True) for arg in args if isinstance(arg, Identifier))
+      case IfElse(cond, true, false):
+        p = all([_pure(cond), _pure(true), _pure(false)])
+      case Let(_, value, body):
+        p = all([_pure(value), _pure(body)])
+      case LetRV(_, _, distribution, expression):
+        p = all([_pure(distribution), _pure(expression)])
+      case _:
+        raise ValueError(expr)
+    table[id(expr)] = p
+    return p
+
+  # Recomputes the table until the purity of functions does not change
+  changed = True
+  while changed:
+    table: Dict[int, bool] = {}
+    changed = False
+    for f in program.functions:
+      if not _pure(f.body) and functions[f.name]:
+        functions[f.name] = False
+        changed = True
+    _pure(program.main)
+
+  program.purity.update(table)
+  return program.purity
+
+def get_lst(l: Expr[SymExpr]) -> PList[SymExpr]:
   match l:
     case Lst(exprs):
       return exprs
     case Const(exprs):
       if isinstance(exprs, list):
-        return [Const(e) for e in exprs]
+        return PList.of(map(Const, exprs))
       else:
         raise ValueError(exprs)
     case _:
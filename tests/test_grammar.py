@@ -0,0 +1,226 @@
+import pytest
+import copy
+import pickle
+import math
+import os
+import json
+import hashlib
+import dataclasses
+from enum import Enum
+from weakref import ref
+
+from siren.grammar import *
+from siren.utils import purity
+import siren.parser as parser
+
+def test_intern():
+  x = RandomVar("x")
+  assert RandomVar("x") is x
+  assert Add(x, Const(1.)) is Add(RandomVar("x"), Const(1.))
+  assert Normal(Add(x, Const(1.)), Const(2.)) is Normal(Add(x, Const(1.)), Const(2.))
+  assert Delta(Const(1.), sampled=True) is Delta(Const(1.), True)
+  assert Add(x, Const(1.)) is not Add(Const(1.), x)
+  assert hash(Add(x, Const(1.))) == hash(Add(x, Const(1.)))
+
+def test_slots():
+  # No node of the grammar has a __dict__
+  import siren.grammar as grammar
+  classes = [c for c in vars(grammar).values() if isinstance(c, type) and dataclasses.is_dataclass(c)]
+  assert len(classes) > 50
+  for c in classes:
+    assert c.__dictoffset__ == 0, c
+
+  x = RandomVar("x")
+  for e in [x, Const(1.), Add(x, Const(1.)), Normal(x, Const(1.)), Lst(PList.of([x])), PList.of([x]),
+            Identifier(None, "x"), parser.parse_program('let x <- gaussian(0., 1.) in x + 1.')]:
+    assert not hasattr(e, '__dict__')
+    with pytest.raises((AttributeError, TypeError)):
+      e.other = 1
+
+def test_intern_parsed():
+  # The symbolic expressions of programs parsed separately are the same objects
+  source = 'let x <- gaussian(0., 1.) in observe(beta(2., 3.), 0.5)'
+  def _exprs(program):
+    todo, exprs = [program.main], []
+    while len(todo) > 0:
+      e = todo.pop()
+      if isinstance(e, SymExpr):
+        exprs.append(e)
+      if dataclasses.is_dataclass(e):
+        todo.extend(getattr(e, f.name) for f in dataclasses.fields(e) if f.compare)
+      elif isinstance(e, (list, tuple)):
+        todo.extend(e)
+    return exprs
+  exprs1 = _exprs(parser.parse_program(source))
+  exprs2 = _exprs(parser.parse_program(source))
+  assert len(exprs1) > 0 and len(exprs1) == len(exprs2)
+  assert all(e1 is e2 for e1, e2 in zip(exprs1, exprs2))
+
+def test_intern_free():
+  # Freed expressions leave the table
+  from siren.grammar import Interned
+  e = Add(RandomVar("x"), Const(12345.))
+  key = next(k for k, r in Interned.table.items() if r() is e)
+  del e
+  assert key not in Interned.table
+
+  # but not the expression that replaced them
+  e = Add(RandomVar("x"), Const(12345.))
+  other = type.__call__(Add, RandomVar("x"), Const(12345.))
+  Interned.table[key] = ref(other)
+  del e
+  assert Interned.table.pop(key)() is other
+
+def test_intern_values():
+  # Values of different types stay distinct but are still equal
+  assert Const(1) is not Const(1.)
+  assert Const(1) == Const(1.)
+  assert Const(True) is not Const(1)
+  assert Const(0.) is not Const(-0.)
+  assert math.copysign(1., Const(-0.).v) == -1.
+  assert Const((1, 2.)) is Const((1, 2.))
+  assert Const((1, 2.)) is not Const((1., 2))
+
+def test_intern_unhashable():
+  # Values that are lists are not interned, but are still compared structurally
+  assert Const([1., 2.]) is not Const([1., 2.])
+  assert Const([1., 2.]) == Const([1., 2.])
+
+def test_plist():
+  x, y = RandomVar("x"), RandomVar("y")
+  l = PList.of([x, y])
+  assert PList.of([x, y]) is l
+  assert l.cons(x).tail is l
+  assert Lst(l.cons(x)) is Lst(PList.of([x, x, y]))
+  assert len(l) == 2 and l.head is x and l[1] is y and l[-1] is y
+  assert list(l.rev()) == [y, x]
+  assert PList.of([Const(1)]) == PList.of([Const(1.)])
+  assert PList.of([Const([1.])]) == PList.of([Const([1.])])
+
+  # Long lists are hashed and compared without recursing
+  long = PList.of(map(Const, range(100000)))
+  assert hash(long) == hash(PList.of(map(Const, range(100000))))
+  assert long.cons(Const([1.])) == long.cons(Const([1.]))
+
+@pytest.mark.parametrize("copier", [
+  copy.copy,
+  copy.deepcopy,
+  lambda e: pickle.loads(pickle.dumps(e)),
+])
+def test_intern_copy(copier):
+  e = Normal(Add(RandomVar("x"), Const(1.)), Const(2.))
+  assert copier(e) is e
+  l = Lst(PList.of([e, RandomVar("y")]))
+  assert copier(l) is l
+
+def test_rvs():
+  x, y = RandomVar("x"), RandomVar("y")
+  e = Normal(Add(x, Mul(y, x)), Ite(Eq(y, Const(1.)), x, Const(2.)))
+  assert e.rvs() == (x, y)
+  assert e.rvs() is e.rvs()
+  assert Lst(PList.of([y, Add(x, y)])).rvs() == (y, x)
+  assert Const(1.).rvs() == ()
+
+def test_purity():
+  program = parser.parse_program('''
+val noisy = fun x ->
+  let y <- gaussian(x, 1.) in
+  let () = observe(gaussian(y, 1.), 0.) in
+  y
+in
+val loop = fun (x, n) ->
+  if n = 0 then noisy(x) else loop(x, n - 1)
+in
+val id = fun x -> x in
+let x <- gaussian(0., 1.) in
+(List.map(id, [x]), List.map(loop, [(x, 2)]), if x < 0. then id(x) else x)
+''')
+  table = purity(program)
+  assert purity(program) is table
+
+  functions = {f.name.name: f for f in program.functions}
+  assert not table[id(functions['noisy'].body)]
+  assert not table[id(functions['loop'].body)]
+  assert table[id(functions['id'].body)]
+
+  id_map, rest = program.main.body.args
+  loop_map, ite = rest.args
+  assert table[id(id_map)]
+  assert not table[id(loop_map)]
+  assert table[id(ite)]
+
+def test_parse():
+  source = '''
+let x = 1 + 2 * 3 = 7 in
+let y = 1 :: 2 :: nil in
+(x, y)
+'''
+  program = parser.parse_program(source)
+  add = GenericOp(Operator.add, [Const(1.), GenericOp(Operator.mul, [Const(2.), Const(3.)])])
+  assert program.main.value == GenericOp(Operator.eq, [add, Const(7.)])
+  nil = GenericOp(Operator.lst, [])
+  assert program.main.body.value == \
+    GenericOp(Operator.cons, [Const(1.), GenericOp(Operator.cons, [Const(2.), nil])])
+
+  # Parsing again hits the on-disk cache
+  assert parser.parse_program(source) == program
+
+def test_parse_cache(tmp_path, monkeypatch):
+  source = 'let x = 1 in x'
+  cache_dir = tmp_path / 'siren'
+  monkeypatch.setattr(parser, 'CACHE_DIR', str(cache_dir))
+
+  # The cache is only created for the user
+  program = parser.parse_program(source)
+  assert cache_dir.stat().st_mode & 0o777 == 0o700
+  assert parser.parse_program(source) == program
+
+  # A cache others can write to is not used
+  cache_dir.chmod(0o777)
+  (programs_dir,) = cache_dir.glob('programs-*')
+  for entry in programs_dir.iterdir():
+    entry.write_bytes(b'corrupt')
+  assert parser.parse_program(source) == program
+
+  # Corrupt entries are parsed again
+  cache_dir.chmod(0o700)
+  with pytest.warns(UserWarning):
+    assert parser.parse_program(source) == program
+  assert parser.parse_program(source) == program
+
+def test_parse_dangling_else():
+  # The else branch extends over binary operators, as the body of a let
+  program = parser.parse_program('if 50 < y then 1 else x + 0.1')
+  assert isinstance(program.main, IfElse)
+  assert program.main.else_ == GenericOp(Operator.add, [Identifier(None, 'x'), Const(0.1)])
+
+  program = parser.parse_program('(if 50 < y then 1 else x) + 0.1')
+  assert isinstance(program.main, GenericOp) and isinstance(program.main.args[0], IfElse)
+
+# Structure of an AST, independent of how the nodes are represented
+def _structure(x):
+  if isinstance(x, Enum):
+    return x.name
+  elif dataclasses.is_dataclass(x):
+    return [type(x).__name__] + [_structure(getattr(x, f.name)) for f in dataclasses.fields(x) if f.compare]
+  elif isinstance(x, (list, tuple)):
+    return [_structure(e) for e in x]
+  else:
+    return [type(x).__name__, x]
+
+with open(os.path.join('tests', 'baseline_asts.json')) as f:
+  baseline_asts = json.load(f)
+
+# The hashes of the structures of the ASTs of the benchmarks and examples, as parsed by the
+# Earley parser the LALR parser replaced
+@pytest.mark.parametrize("program_path", sorted(baseline_asts))
+def test_parse_baseline(program_path):
+  with open(program_path) as f:
+    program = parser.parse_program(f.read())
+  assert hashlib.sha256(json.dumps(_structure(program)).encode()).hexdigest() == baseline_asts[program_path]
+
+def test_parse_underscore():
+  # _ is a variable like any other
+  program = parser.parse_program('let (_, x) = (1, 2) in _')
+  assert program.main.var == [[Identifier(None, '_')], [Identifier(None, 'x')]]
+  assert program.main.body == Identifier(None, '_')
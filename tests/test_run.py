@@ -1,30 +1,41 @@
 import pytest
 import os
+import numpy as np
+import pickle
 
 from siren.inference import SSIState, DSState, BPState
+from siren.inference.interface import resampling_schemes
+from siren.inference.vectorized import VectorizedProbState
 import siren.parser as parser
-from siren.evaluate import SMC, MH
-from siren.inference_plan import runtime_inference_plan, InferencePlan, DistrEnc
+from siren.evaluate import SMC, VectorizedSMC, MH, Stream, Filter, CompiledProgram
+from siren.inference_plan import runtime_inference_plan, encodings_plan, distribution_encodings, InferencePlan, DistrEnc
 from siren.grammar import Const, Identifier
 from siren.utils import get_lst, get_pair
 
-def run(program_path, handler, inference_method):
+def load(program_path):
   with open(program_path) as f:
     program = parser.parse_program(f.read())
+  return program, os.path.dirname(os.path.realpath(program_path))
 
-    file_dir = os.path.dirname(os.path.realpath(program_path))
-    handler = handler()
-    res, probstate = handler.infer(
-      program,
-      inference_method,
-      file_dir,
-      seed=0,
-      n_particles=10,
-      n_samples=10,
-    ) 
-    runtime_plan = runtime_inference_plan(probstate)
+def infer(program_path, handler, inference_method, **kwargs):
+  program, file_dir = load(program_path)
+  return handler().infer(
+    program,
+    inference_method,
+    file_dir,
+    **{'seed': 0, 'n_particles': 10, 'n_samples': 10, **kwargs},
+  )
 
-    return res, runtime_plan
+def run(program_path, handler, inference_method, **kwargs):
+  res, probstate = infer(program_path, handler, inference_method, **kwargs)
+  runtime_plan = runtime_inference_plan(probstate)
+
+  return res, runtime_plan
+
+# Filter over online.si (or the given program), with the observations pushed into data/online.csv
+def online_filter(inference_method, program='online.si', **kwargs):
+  program, file_dir = load(os.path.join('tests', 'programs', program))
+  return Filter(program, inference_method, file_dir, 'data/online.csv', **{'seed': 0, 'n_particles': 10, **kwargs})
 
 @pytest.mark.parametrize("handler", [SMC, MH])
 @pytest.mark.parametrize("method", [SSIState, DSState, BPState])
@@ -34,7 +45,7 @@ def test_coin(handler, method):
 
   res, runtime_plan = run(program_path, handler, method)
   if method == BPState:
-    assert isinstance(res, Const) and round(res, 2) == 0.70
+    assert isinstance(res, Const) and round(res, 2) == {SMC: 0.84, MH: 0.91}[handler]
     assert runtime_plan[var] == DistrEnc.sample
   else:
     assert isinstance(res, Const) and round(res, 2) == 0.9
@@ -63,9 +74,9 @@ def test_envnoise(handler, method):
   assert isinstance(x, Const)
   assert isinstance(q, Const)
   assert isinstance(r, Const)
-  assert round(x, 2) == -2.52
-  assert round(q, 2) == 50.47
-  assert round(r, 2) == 1.47
+  assert round(x, 2) == -0.48
+  assert round(q, 2) == 0.60
+  assert round(r, 2) == 18.92
   plan1 = InferencePlan({
     Identifier(module=None, name='invq'): DistrEnc.symbolic,
     Identifier(module=None, name='invr'): DistrEnc.sample,
@@ -103,5 +114,394 @@ def test_tree(handler, method):
   elif method == DSState:
     assert runtime_plan[Identifier(module=None, name='b')] == DistrEnc.sample
 
+@pytest.mark.parametrize("handler", [SMC, MH])
+@pytest.mark.parametrize("method", [SSIState])
+def test_long_fold(handler, method):
+  # Evaluation depth does not depend on the length of the folded list
+  program_path = os.path.join('tests', 'programs', 'longfold.si')
+
+  res, _ = run(program_path, handler, method)
+  assert isinstance(res, Const) and round(res) == 9999
+
+@pytest.mark.parametrize("handler", [SMC, MH])
+def test_sum_fold(handler):
+  # Folding over 20000 elements keeps the accumulator of each step
+  program_path = os.path.join('tests', 'programs', 'sumfold.si')
+
+  res, _ = run(program_path, handler, SSIState)
+  assert res == Const(sum(range(20000)))
+
+def test_long_chain():
+  # Delayed sampling walks the chain of the 1000 states without recursing on each of them
+  program_path = os.path.join('tests', 'programs', 'longkalman.si')
+  res, runtime_plan = run(program_path, SMC, DSState, n_particles=2)
+  l = get_lst(res)
+  assert isinstance(l[-1], Const) and abs(l[-1].v - 1000.) < 5.
+  assert runtime_plan[Identifier(module=None, name='x')] == DistrEnc.sample
+
+@pytest.mark.parametrize("method", [SSIState, DSState])
+def test_compiled(method):
+  # Same results as the interpreter the programs were evaluated with before they were compiled
+  program_path = os.path.join('tests', 'programs', 'constructs.si')
+  res, _ = run(program_path, SMC, method)
+  p, rest = get_pair(res)
+  y, last = get_pair(rest)
+  assert np.isclose(p.v, 0.42857142857142855)
+  assert np.isclose(y.v, 3.8)
+  assert np.isclose(last.v, 2.2705882352941176)
+
+  # The interpreter only ran it with a raised recursion limit
+  program_path = os.path.join('tests', 'programs', 'deepfold.si')
+  res, _ = run(program_path, SMC, method, n_particles=1)
+  assert isinstance(res, Const) and np.isclose(res.v, 1499.3819660112497)
+
+def test_compile_once(monkeypatch):
+  # Each node is compiled once, instead of once for each branch of the ifelse it is in
+  depth = 20
+  source = ''.join(f'if x < {i}. then {i}. else ' for i in range(depth)) + 'x'
+  program = parser.parse_program(f'let x = 0.5 in {source}')
+  calls = []
+  compile_ifelse = CompiledProgram._compile_ifelse
+  def _compile_ifelse(self, *args):
+    calls.append(args)
+    return compile_ifelse(self, *args)
+  monkeypatch.setattr(CompiledProgram, '_compile_ifelse', _compile_ifelse)
+  CompiledProgram(program, '.')
+  assert len(calls) == depth
+
+  res, _ = SMC().infer(program, SSIState, '.', seed=0)
+  assert res == Const(1.)
+
+@pytest.mark.parametrize("handler", [SMC, MH])
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_resume(handler, method):
+  # Particles resume from resample inside nested function calls
+  program_path = os.path.join('tests', 'programs', 'resume.si')
+
+  res, _ = run(program_path, handler, method)
+  total, xs = get_pair(res)
+  assert isinstance(total, Const) and round(total) == 15
+  assert [round(x) for x in get_lst(xs)] == [2, 3, 4]
+
+@pytest.mark.parametrize("handler", [SMC, MH])
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_read_file(handler, method):
+  # Files are read relative to the program
+  program_path = os.path.join('tests', 'programs', 'readfile.si')
+
+  res, _ = run(program_path, handler, method)
+  n, total = get_pair(res)
+  assert isinstance(n, Const) and round(n) == 3
+  assert isinstance(total, Const) and abs(total.v - 10.5) < 3.
+
+def test_read_file_shared():
+  # All particles hold the same list of rows, and the same row objects
+  _, particles = infer(os.path.join('tests', 'programs', 'readrows.si'), SMC, SSIState)
+  rows = [get_lst(get_pair(p.final_expr)[1]) for p in particles]
+  assert len(rows[0]) == 3
+  for other in rows[1:]:
+    assert other is rows[0]
+    assert all(get_lst(r1) is get_lst(r2) for r1, r2 in zip(rows[0], other))
+
+@pytest.mark.parametrize("handler", [SMC, MH])
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_stream_file(handler, method):
+  # Folds over the rows of a file as they are read
+  program_path = os.path.join('tests', 'programs', 'streamfile.si')
+
+  res, _ = run(program_path, handler, method)
+  assert isinstance(res, Const) and abs(res.v - 10.5) < 3.
+
+def test_stream_growing(tmp_path):
+  path = tmp_path / 'data.csv'
+  path.write_text('x\n1.\n')
+  stream = Stream(open(path))
+  stream.source.readline()
+
+  row, rest = stream.force()
+  assert row == Const([1.])
+  # Rows written after the stream is opened are read when reached
+  with open(path, 'a') as f:
+    f.write('2.\n')
+  row, rest = rest.force()
+  assert row == Const([2.])
+  assert rest.force() is None
+  # Cells keep their rows once read
+  assert stream.force()[0] == Const([1.])
+  # Streams are sent to other processes with their rows
+  row, rest = pickle.loads(pickle.dumps(stream)).force()
+  assert row == Const([1.]) and rest.force()[0] == Const([2.])
+
+def test_stream_pickle(tmp_path):
+  path = tmp_path / 'data.csv'
+  path.write_text('x\n1.\n2.\n3.\n')
+  stream = Stream(open(path))
+  stream.source.readline()
+  _, rest = stream.force()
+
+  # Only the rows read so far are sent, the others are read from the file in the other process
+  copied = pickle.loads(pickle.dumps(stream))
+  assert rest.source is not None and rest.row is None
+  row, copied_rest = copied.force()
+  assert row == Const([1.]) and copied_rest.source is not None
+  row, copied_rest = copied_rest.force()
+  assert row == Const([2.]) and copied_rest.force()[0] == Const([3.])
+  # The stream sent is still read from its own file
+  assert rest.force()[0] == Const([2.])
+
+  # The rows of fed streams cannot be read again
+  with pytest.raises(ValueError):
+    pickle.dumps(online_filter(SSIState).compiled.feeds.popitem()[1])
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_jobs(method):
+  # Particles are evaluated in worker processes, and moved between them when resampled,
+  # drawing the same values as when evaluated in order
+  for program in ['kalman.si', 'streamfile.si']:
+    program_path = os.path.join('tests', 'programs', program)
+    res, plan = run(program_path, SMC, method, n_jobs=3)
+    serial_res, serial_plan = run(program_path, SMC, method)
+    assert res == serial_res
+    assert plan == serial_plan
+
+def test_jobs_compress():
+  # Workers do not compress their particles, so both cannot be asked for
+  with pytest.raises(ValueError):
+    infer(os.path.join('tests', 'programs', 'kalman.si'), SMC, SSIState, n_jobs=3, compress=True)
+
+@pytest.mark.parametrize("kwargs", [{'n_jobs': 3}, {'compress': True}])
+def test_vectorized_options(kwargs):
+  with pytest.raises(ValueError):
+    infer(os.path.join('tests', 'programs', 'kalman.si'), VectorizedSMC, SSIState, **kwargs)
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_filter(method):
+  # Observations are pushed one at a time into the stream of the program
+  online = online_filter(method)
+  x = Identifier(module=None, name='x')
+  for obs in range(1, 11):
+    particles = online.step([float(obs)])
+    assert not particles.finished
+    est = particles.posterior(x)
+    assert isinstance(est, Const) and abs(est.v - obs) < 2.
+
+  res, particles = online.close()
+  assert particles.finished
+  assert isinstance(res, Const) and abs(res.v - 10.) < 2.
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_filter_no_resample(method, tmp_path):
+  # Without resample, waiting for the rows does not resample the particles,
+  # so filtering gives the results of reading the rows from the file
+  obs = [float(i) for i in range(1, 11)]
+  os.mkdir(tmp_path / 'data')
+  (tmp_path / 'data' / 'online.csv').write_text('obs\n' + ''.join(f'{o}\n' for o in obs))
+  program, _ = load(os.path.join('tests', 'programs', 'onlinenoresample.si'))
+  res, particles = SMC().infer(program, method, str(tmp_path), seed=0, n_particles=10)
+
+  online = online_filter(method, 'onlinenoresample.si')
+  for o in obs:
+    online.step([o])
+  online_res, online_particles = online.close()
+  assert online_res == res
+  assert [p.score for p in online_particles] == [p.score for p in particles]
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_filter_reopen(method):
+  # The fed stream is opened again once all the rows are pushed
+  online = online_filter(method, 'onlinetwice.si')
+  for obs in range(1, 11):
+    online.step([float(obs)])
+  res, _ = online.close()
+  x, n = get_pair(res)
+  assert isinstance(x, Const) and abs(x.v - 10.) < 2.
+  assert n == Const(10.)
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_gc(method):
+  def _run(gc_growth):
+    online = online_filter(method, gc_growth=gc_growth)
+    sizes = []
+    for obs in range(1, 101):
+      particles = online.step([float(obs)])
+      sizes.append(max(len(p.state) for p in particles))
+    res, particles = online.close()
+    return res, particles, max(sizes)
+
+  # Only the variables reachable from the particles are kept, without changing the results
+  res, particles, size = _run(2.)
+  no_gc_res, _, no_gc_size = _run(None)
+  assert size < 10 and no_gc_size == 200
+  assert res == no_gc_res
+  assert runtime_inference_plan(particles)[Identifier(module=None, name='x')] == DistrEnc.symbolic
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_gc_pending(method):
+  program_path = os.path.join('tests', 'programs', 'pending.si')
+
+  # The observation of p is kept while q has not been conditioned on it
+  res, _ = run(program_path, SMC, method, n_particles=200)
+  no_gc_res, _ = run(program_path, SMC, method, n_particles=200, gc_growth=None)
+  assert res == no_gc_res
+  assert isinstance(res, Const) and abs(res.v - 10. / 3.) < 0.2
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_batched_result(method):
+  _, particles = infer(os.path.join('tests', 'programs', 'resume.si'), SMC, method)
+
+  # The means of all positions are computed at once, as with the mixture of each position
+  total, xs = get_pair(particles.batched_result())
+  total_mixture, xs_mixture = particles.mixture().get_pair_mixture()
+  assert np.isclose(total.v, total_mixture.mean())
+  assert np.allclose([x.v for x in get_lst(xs)], [m.mean() for m in xs_mixture.get_lst_mixture()])
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_streamed_plan(method):
+  # The encodings of the particles are merged at each resample point
+  online = online_filter(method)
+  x = Identifier(module=None, name='x')
+  for obs in range(1, 11):
+    particles = online.step([float(obs)])
+    assert encodings_plan(particles.encodings)[x] == DistrEnc.symbolic
+
+  _, particles = online.close()
+  plan = InferencePlan()
+  for particle in particles:
+    plan = plan | distribution_encodings(particle)
+  assert runtime_inference_plan(particles) == plan
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_mh_gc(method, monkeypatch):
+  # The checkpoints of MH only keep the variables reachable from the particle
+  program_path = os.path.join('tests', 'programs', 'kalman.si')
+  sizes = []
+  run = MH.run
+  def _run(self, particle, program, trace, gc_growth):
+    particle = run(self, particle, program, trace, gc_growth)
+    sizes.extend(len(p.state) for p, _ in trace)
+    return particle
+  monkeypatch.setattr(MH, 'run', _run)
+
+  res, _ = infer(program_path, MH, method, n_samples=20)
+  size = max(sizes)
+  sizes.clear()
+  no_gc_res, _ = infer(program_path, MH, method, n_samples=20, gc_growth=None)
+  assert size < 10 and max(sizes) >= 198
+  assert res == no_gc_res
+
+def test_mh_replay(monkeypatch):
+  assumes = []
+  assume = SSIState.assume
+  def _assume(self, *args):
+    assumes.append(args[0])
+    return assume(self, *args)
+  monkeypatch.setattr(SSIState, 'assume', _assume)
+
+  # Each run after the first is replayed from the last resample point before the
+  # regenerated sample site, instead of evaluating the 100 steps of the program again
+  program_path = os.path.join('tests', 'programs', 'kalman.si')
+  res, _ = run(program_path, MH, SSIState)
+  n_runs = 11
+  assert len(assumes) < 0.75 * n_runs * 200
+  l = get_lst(res)
+  assert isinstance(l[-1], Const) and len(l) == 101
+
+@pytest.mark.parametrize("resampling", ["systematic", "stratified", "residual"])
+def test_resampling(resampling):
+  program_path = os.path.join('tests', 'programs', 'kalman.si')
+
+  res, _ = run(program_path, VectorizedSMC, SSIState, resampling=resampling)
+  l = get_lst(res)
+  assert isinstance(l[-1], Const)
+  assert round(l[-1]) == 99
+
+  program_path = os.path.join('tests', 'programs', 'resume.si')
+  res, _ = run(program_path, SMC, SSIState, resampling=resampling)
+  total, _ = get_pair(res)
+  assert isinstance(total, Const) and round(total) == 15
+
+@pytest.mark.parametrize("resampling", ["systematic", "residual"])
+def test_resampling_counts(resampling):
+  # Each particle is kept floor(n * p) or ceil(n * p) times
+  rng = np.random.default_rng(0)
+  probabilities = rng.dirichlet(np.ones(50))
+  counts = np.bincount(resampling_schemes[resampling](rng, probabilities, 1000), minlength=50)
+  assert counts.sum() == 1000
+  assert np.all(counts >= np.floor(1000 * probabilities))
+  if resampling == "systematic":
+    assert np.all(counts <= np.ceil(1000 * probabilities))
+
+@pytest.mark.parametrize("ess_threshold", [None, 0.5, 0.])
+def test_ess_threshold(ess_threshold, monkeypatch):
+  resamples = []
+  resample = VectorizedProbState.resample
+  def _resample(self):
+    resamples.append(self.ess())
+    return resample(self)
+  monkeypatch.setattr(VectorizedProbState, 'resample', _resample)
+
+  program_path = os.path.join('tests', 'programs', 'kalman.si')
+  res, _ = run(program_path, VectorizedSMC, SSIState, ess_threshold=ess_threshold)
+  l = get_lst(res)
+  assert isinstance(l[-1], Const)
+  # Particles are only resampled when their effective sample size drops below the threshold
+  if ess_threshold is None:
+    assert len(resamples) == 100
+  else:
+    assert all(ess < ess_threshold * 10 for ess in resamples)
+    assert len(resamples) < 100
+  if ess_threshold != 0.:
+    assert abs(l[-1].v - 99.5) < 2.
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_compress(method):
+  # Copies that do not draw values are evaluated once
+  res, particles = infer(os.path.join('tests', 'programs', 'resume.si'), SMC, method, compress=True)
+  assert len(particles) < 10 and sum(p.count for p in particles) == 10
+  total, _ = get_pair(res)
+  assert isinstance(total, Const) and round(total) == 15
+
+  # Copies that draw values are split
+  res, particles = infer(os.path.join('tests', 'programs', 'kalman.si'), SMC, method, compress=True)
+  assert sum(p.count for p in particles) == 10
+  l = get_lst(res)
+  assert isinstance(l[-1], Const) and round(l[-1]) == 99
+
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_vectorized(method):
+  # All the particles are evaluated at once
+  program_path = os.path.join('tests', 'programs', 'kalman.si')
+
+  res, runtime_plan = run(program_path, VectorizedSMC, method)
+  l = get_lst(res)
+  assert isinstance(l[-1], Const)
+  assert round(l[-1]) == 99
+  assert runtime_plan[Identifier(module=None, name='x')] == DistrEnc.sample
+
+  program_path = os.path.join('tests', 'programs', 'resume.si')
+  res, _ = run(program_path, VectorizedSMC, method)
+  total, xs = get_pair(res)
+  assert isinstance(total, Const) and round(total) == 15
+  assert [round(x) for x in get_lst(xs)] == [2, 3, 4]
+
+@pytest.mark.parametrize("program", ['branch.si', 'range.si'])
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_vectorized_fallback(program, method):
+  # Particles taking different branches or needing different values are evaluated one at a time
+  program_path = os.path.join('tests', 'programs', program)
+
+  with pytest.warns(UserWarning, match="falling back"):
+    res, _ = run(program_path, VectorizedSMC, method)
+  assert isinstance(res, Const) and res.v >= 0.
+
+@pytest.mark.filterwarnings("error")
+@pytest.mark.parametrize("method", [SSIState, DSState, BPState])
+def test_vectorized_error(method):
+  # Errors of the program are not mistaken for particles that cannot be vectorized
+  program_path = os.path.join('tests', 'programs', 'empty.si')
+
+  with pytest.raises(ValueError):
+    run(program_path, VectorizedSMC, method)
+
 if __name__ == '__main__':
   pytest.main()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import pytest
+from copy import copy
 
 from siren.grammar import *
 from siren.evaluate import SMC
@@ -117,5 +118,59 @@ def test_gaussian_conjugate():
     case _:
       assert False
 
+def test_copy_on_write():
+  state = SSIState(lambda state: state.value_impl)
+  rv1 = state.assume(state.new_var(), Identifier(None, "beta_prior"), None, Beta(Const(1), Const(1)))
+  rv2 = state.assume(state.new_var(), Identifier(None, "bernoulli"), None, Bernoulli(rv1))
+
+  # Copies share the state until one of them is updated
+  new_state = copy(state)
+  assert new_state.state is state.state
+  new_state.observe(rv2, Const(True))
+  assert new_state.state is not state.state
+  assert state.state[rv2] is not new_state.state[rv2]
+  assert state.distr(rv1) == Beta(Const(1), Const(1))
+  assert new_state.eval_distr(new_state.distr(rv1)) == Beta(Const(2.), Const(1.))
+
+  # Entries are copied the first time they are updated
+  entry = new_state.state[rv1]
+  assert entry is not state.state[rv1]
+  new_state.set_annotation(rv1, None)
+  assert new_state.state[rv1] is entry
+
+def test_copy_shares_entries():
+  state = SSIState(lambda state: state.value_impl)
+  rvs = [state.assume(state.new_var(), Identifier(None, f"x{i}"), None, Normal(Const(0.), Const(1.)))
+         for i in range(100)]
+
+  # A write copies only the entry it updates, the other entries stay shared
+  new_state = copy(state)
+  new_state.set_entry(rvs[0], annotation=None)
+  assert new_state.state[rvs[0]] is not state.state[rvs[0]]
+  assert new_state.annotation(rvs[0]) is None
+  assert all(new_state.state[rv] is state.state[rv] for rv in rvs[1:])
+  assert len(new_state) == len(state) == 100
+
+def test_means():
+  # Chain of gaussians observed at each step, as in a Kalman filter
+  def _chain():
+    state = SSIState(lambda state: state.value_impl)
+    xs = [Const(0.)]
+    for obs in range(1, 101):
+      x = state.assume(state.new_var(), Identifier(None, "x"), None, Normal(xs[-1], Const(1.)))
+      y = state.assume(state.new_var(), None, None, Normal(x, Const(1.)))
+      state.observe(y, Const(float(obs)))
+      xs.append(x)
+    return state, xs
+
+  state, xs = _chain()
+  # Roots come first, after observations the last variable is the root of the chain
+  assert [rv for rv in state.topological_order(xs[1:]) if rv in xs] == xs[:0:-1]
+
+  # Each variable is marginalized once, giving the same means as one at a time
+  means = state.means(xs + [Add(xs[1], Const(1.))])
+  state, xs = _chain()
+  assert means == pytest.approx([state.mean(x) for x in xs] + [state.mean(Add(xs[1], Const(1.)))])
+
 if __name__ == '__main__':
   pytest.main()
\ No newline at end of file